@@ -1,11 +1,20 @@
 #!/usr/bin/python3
 
-from pyboard import Pyboard, PyboardError
+from pyboard import Pyboard, PyboardError, stdout
 
 import os
 import sys
 import argparse
 import time
+import binascii
+import tempfile
+import hashlib
+import ast
+import io
+import tokenize
+import re
+import json
+from collections import namedtuple
 
 #Version of this script
 APP_VERSION = "0.0.6"
@@ -19,18 +28,88 @@ FLUSH_AFTER_LINES = 5
 #File types that are considered as text files, otherwise they'll be treated as binary file.
 TEXT_FILES = (".py", ".txt")
 
+#Name of the file with the gitignore-style rules of the items which won't be flashed
+IGNORE_FILE_NAME = ".flashignore"
+
+#Items which are never flashed, unless they are included explicitly
+DEFAULT_IGNORE_RULES = ("*.pyc", "__pycache__/", "/" + IGNORE_FILE_NAME)
+
+#Directory where the minified sources are cached
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "upyflasher")
+
+#Version of the output of the minifier. It must be changed whenever minifySource changes,
+#so the sources minified by older versions aren't taken from the cache.
+MINIFY_VERSION = "3"
+
 #Size of the buffer for binary copy
 BINARY_BUFFER_SIZE = 64
 
-def printVerbose(message, verbose=False):
+#Times the failed chunks of a binary copy are sent again
+BINARY_RETRIES = 5
+
+#Size of the blocks compared on delta transfers
+DELTA_BLOCK_SIZE = 1024
+
+#Amount of new data sent per command on delta transfers
+DELTA_DATA_SIZE = 512
+
+#Size of the blocks read from the remote files on pulling
+PULL_BUFFER_SIZE = 1536
+
+#Path where the local code is mounted on the device in mount mode
+MOUNT_POINT = "/remote"
+
+#Mark of the requests sent by the device in mount mode
+MOUNT_REQUEST_MARK = b"\x18"
+
+#Amount of bytes written into the block device per command when a filesystem image is flashed.
+IMAGE_CHUNK_SIZE = 2048
+
+#Files up to this size are written with a single command, several of them at once
+SMALL_FILE_SIZE = 256
+
+#Amount of contents of small files written per command
+SMALL_FILES_BATCH_SIZE = 1024
+
+#Name of the file within CACHE_DIR where the measured throughput of the links is stored
+THROUGHPUT_CACHE_NAME = "throughput.json"
+
+#Throughput of the link assumed until it's measured, in bytes per second
+DEFAULT_THROUGHPUT = 1000
+
+#Width of the progress bar in characters
+PROGRESS_BAR_WIDTH = 30
+
+#Minimum time between redraws of the progress bar, in seconds
+PROGRESS_REFRESH_TIME = 0.1
+
+#Transfers shorter than this, in seconds, aren't used to measure the throughput
+PROGRESS_MIN_MEASURE_TIME = 2
+
+def printVerbose(message, verbose=False, report=None):
     '''
     Prints a message when verbose is required
     
     @param message: The message to be printed
     @param verbose: (optional, default=False) Flag to indicate whether print the message or not
+    @param report: (optional, default=None) Function which receives the message. If None, it is printed.
     '''
 
     if verbose:
+        _report(message, report)
+
+
+def _report(message, report=None):
+    '''
+    Prints a message, or passes it to the given function.
+    
+    @param message: The message to be printed
+    @param report: (optional, default=None) Function which receives the message. If None, it is printed.
+    '''
+
+    if report:
+        report(message)
+    else:
         print(message)
 
 
@@ -43,20 +122,41 @@ def remoteEval(pybObj, expression):
     @returns: Result of the expression as a string.
     '''
 
-    return eval(pybObj.eval(expression).decode("ascii"))
+    return ast.literal_eval(pybObj.eval(expression).decode("utf8"))
+
+
+def remoteEvalMany(pybObj, expressions):
+    '''
+    Evaluates several expressions on the remote device at once.
+    
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param expressions: Python expressions as strings.
+    @returns: Results of the expressions, in the same order.
+    @rtype: list
+    @raise PyboardError: Any of the expressions raised an exception.
+    '''
+
+    values = []
+    for expression, (succeeded, value) in zip(expressions, pybObj.eval_many(expressions)):
+        if not succeeded:
+            raise PyboardError("exception", expression, value)
+        values.append(value)
+    
+    return values
     
     
-def remotePathIsFile(pybObj, remotePath):
+def remotePathExists(pybObj, remotePath):
     '''
-    Checks whether a path of the remote device is a file.
+    Checks whether a path of the remote device exists.
     
     @param pybObj: Interface with the remote device. Must be initializated previously.
     @param remotePath: Path to the item to be checked.
-    @return: True if the remote path is a file, otherwise False
+    @return: True if the remote path exists, otherwise False
     @rtype: bool
     '''
     
-    return remoteEval(pybObj, "os.stat('{0}')[0]".format(remotePath)) == 32768
+    succeeded, _ = pybObj.eval_many(["os.stat({0!r})".format(remotePath)])[0]
+    return succeeded
     
 
 def _doClearMain(pybObj):
@@ -72,20 +172,52 @@ def _doClearMain(pybObj):
     pybObj.exec("f.close()")
 
 
-def _initMain(pybObj):
+def _mainLines(entryPoint=None):
     '''
-    Clears the main.py file but makes the user code on start or reset still available.
+    Builds the contents of the main.py file which makes the user code available on start or reset.
+    
+    @param entryPoint: (optional, default=None) Path to the main function. The notation is like with Python code,
+                       i.e. mymodule.mysubmodule.myfunction. If None, no function will be invoked.
+    @return: Lines of the main.py file, without line endings
+    @rtype: list
+    '''
+
+    lines = ["#Flashed with µPyFlasher v{0}.".format(APP_VERSION),
+             "from sys import path",
+             "path.append(\"/flash/" + APP_DIR_NAME + "\")"]
+    if entryPoint:
+        modulePath = entryPoint[0:entryPoint.rfind(".")]
+        lines += ["#This is the entry-point of the user code.",
+                  "import {0}".format(modulePath),
+                  "{0}()".format(entryPoint)]
+    
+    return lines
+
+
+def _writeMain(pybObj, entryPoint=None):
+    '''
+    Writes the main.py file of the remote device.
     
     @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param entryPoint: (optional, default=None) Path to the main function. See _mainLines.
     '''
 
     pybObj.exec("f = open('main.py', 'w')")
-    pybObj.exec("f.write('#Flashed with µPyFlasher v{0}.\\n')".format(APP_VERSION))
-    pybObj.exec("f.write('from sys import path\\n')")
-    pybObj.exec("f.write('path.append(\"/flash/" + APP_DIR_NAME + "\")\\n')")
+    for line in _mainLines(entryPoint):
+        pybObj.exec("f.write({0!r})".format(line + "\n"))
     pybObj.exec("f.close()")
 
 
+def _initMain(pybObj):
+    '''
+    Clears the main.py file but makes the user code on start or reset still available.
+    
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    '''
+
+    _writeMain(pybObj)
+
+
 def clearMain(pybObj):
     '''
     Executes the "clear main" option.
@@ -112,25 +244,19 @@ def clearMain(pybObj):
         print("Aborted.")
 
 
-def _doSetMain(pybObj, entryPoint):
+def _doSetMain(pybObj, entryPoint, report=None):
     '''
     Sets the entry point function, thus this function will be invoked on device star or reset.
     
     @param pybObj: Interface with the remote device. Must be initializated previously.
     @param entryPoint: Path to the main function. The notation is like with Python code,
                        i.e. mymodule.mysubmodule.myfunction
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
     @type entryPoint: string
     '''
 
-    print("Setting entry point at '" + entryPoint + "'")
-    modulePath = entryPoint[0:entryPoint.rfind(".")]
-    
-    _initMain(pybObj)
-    pybObj.exec("f = open('main.py', 'a')")
-    pybObj.exec("f.write('#This is the entry-point of the user code.\\n')")
-    pybObj.exec("f.write('import {0}\\n')".format(modulePath))
-    pybObj.exec("f.write('{0}()\\n')".format(entryPoint))
-    pybObj.exec("f.close()")
+    _report("Setting entry point at '" + entryPoint + "'", report)
+    _writeMain(pybObj, entryPoint)
 
 
 def setMain(pybObj, entryPoint):
@@ -154,34 +280,398 @@ def setMain(pybObj, entryPoint):
         print("Aborted.")
 
 
-def createDirpath(pybObj, dirpath, verbose):
+def createDirpath(pybObj, dirpath, verbose, report=None):
     '''
     Creates a directory path on the device, if this doesn't exists.
     
     @param pybObj:  Interface with the remote device. Must be initializated previously.
     @param dirpath: Directory path. This must be full path (that means, starting with "/")
     @param verbose: Flag to print some information about the process.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
+    '''
+
+    createDirpaths(pybObj, [dirpath], verbose, report)
+
+
+def createDirpaths(pybObj, dirpaths, verbose, report=None):
+    '''
+    Creates several directory paths on the device, those which don't exist, at once.
+    
+    @param pybObj:  Interface with the remote device. Must be initializated previously.
+    @param dirpaths: Directory paths. They must be full paths (that means, starting with "/")
+    @param verbose: Flag to print some information about the process.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
     '''
 
-    dirpath = dirpath.replace("\\", "/")
-    dirnames = dirpath.lstrip("/flash/").split("/")
-    parentPath = "/flash"
+    #All the levels are checked at once. Listing a missing parent fails, but it also means 
+    #that the directory doesn't exist.
+    expressions = []
+    paths = []
+    for dirpath in dirpaths:
+        dirpath = dirpath.replace("\\", "/")
+        if dirpath.startswith("/flash/"):
+            dirpath = dirpath[len("/flash/"):]
+        parentPath = "/flash"
+        for dirname in dirpath.split("/"):
+            if dirname != "" and dirname != ".":
+                path = parentPath + "/" + dirname
+                if path not in paths:
+                    expressions.append("'{0}' in os.listdir('{1}')".format(dirname, parentPath))
+                    paths.append(path)
+                parentPath = path
     
-    for dirname in dirnames:
-        if dirname != "" and dirname != ".":
-            path = parentPath + "/" + dirname
-            dirExists = remoteEval(pybObj, "'{0}' in os.listdir('{1}')".format(dirname, parentPath))
-            if not dirExists:
-                print("Creating directory '{0}'".format(path))
-                pybObj.exec("os.mkdir('{0}')".format(path))
-            parentPath = path
+    commands = []
+    for path, (succeeded, dirExists) in zip(paths, pybObj.eval_many(expressions)):
+        if not (succeeded and dirExists):
+            _report("Creating directory '{0}'".format(path), report)
+            commands.append("os.mkdir('{0}')".format(path))
+    if commands:
+        pybObj.exec("\n".join(commands))
+
 
 def _exec(pybObj, command):
 
     pybObj.exec_raw_no_follow(command)
+
+
+def _announce(message, progress=None, report=None):
+    '''
+    Prints a message of the process, above the progress bar if there is one.
+
+    @param message: The message to be printed
+    @param progress: (optional, default=None) Progress of the whole transfer. See TransferProgress.
+    @param report: (optional, default=None) Function which receives the message. If None, it is printed.
+    '''
+
+    if report:
+        report(message)
+    elif progress:
+        progress.message(message)
+    else:
+        print(message)
+
+
+def _throughputKey(pybObj):
+    '''
+    Gets the key of the link of a device in the throughput cache.
+
+    @param pybObj: Interface with the remote device.
+    @rtype: str
+    '''
+
+    return str(getattr(pybObj.serial, "port", None) or "default")
+
+
+def loadThroughput(pybObj):
+    '''
+    Reads the last measured throughput of the link with a device.
+
+    @param pybObj: Interface with the remote device.
+    @return: Bytes per second, or None if it was never measured.
+    @rtype: float
+    '''
+
+    try:
+        with open(os.path.join(CACHE_DIR, THROUGHPUT_CACHE_NAME), "r") as f:
+            return json.load(f).get(_throughputKey(pybObj))
+    except (OSError, ValueError):
+        return None
+
+
+def saveThroughput(pybObj, throughput):
+    '''
+    Stores the measured throughput of the link with a device. It's averaged with the previous
+    measure, so a single slow transfer doesn't spoil the estimations.
+
+    @param pybObj: Interface with the remote device.
+    @param throughput: Bytes per second.
+    '''
+
+    cachePath = os.path.join(CACHE_DIR, THROUGHPUT_CACHE_NAME)
+    try:
+        with open(cachePath, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    key = _throughputKey(pybObj)
+    cache[key] = (cache[key] + throughput) / 2.0 if cache.get(key) else throughput
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cachePath, "w") as f:
+            json.dump(cache, f)
+    except OSError:
+        #The cache is optional
+        pass
+
+
+def _formatTime(seconds):
+
+    seconds = int(seconds + 0.5)
+    return "{0}:{1:02d}".format(seconds // 60, seconds % 60)
+
+
+class TransferProgress(object):
+    '''
+    Progress bar of a transfer in bytes, with the estimated remaining time.
+    The estimation is based on the throughput measured so far, or on the given one
+    while there isn't enough data.
+    '''
+
+    def __init__(self, totalBytes, throughput=None, output=None, onUpdate=None):
+        '''
+        @param totalBytes: Amount of bytes to be transferred.
+        @param throughput: (optional, default=None) Expected bytes per second. If None, DEFAULT_THROUGHPUT is used.
+        @param output: (optional, default=None) Stream where the bar is written. If None, stdout is used.
+        @param onUpdate: (optional, default=None) Function invoked instead of drawing the bar, with the
+                         transferred bytes, the total bytes and the estimated remaining seconds.
+        '''
+
+        self.totalBytes = totalBytes
+        self.throughput = throughput or DEFAULT_THROUGHPUT
+        self.output = output or sys.stdout
+        self.onUpdate = onUpdate
+        self.doneBytes = 0
+        self.startTime = time.time()
+        self._lastRender = 0
+        self._lineLength = 0
+
+    def elapsed(self):
+        '''
+        @return: Seconds since the transfer started.
+        @rtype: float
+        '''
+
+        return time.time() - self.startTime
+
+    def measuredThroughput(self):
+        '''
+        @return: Bytes per second transferred so far, or None if there isn't enough data yet.
+        @rtype: float
+        '''
+
+        elapsed = self.elapsed()
+        if elapsed < PROGRESS_MIN_MEASURE_TIME or self.doneBytes == 0:
+            return None
+        return self.doneBytes / elapsed
+
+    def eta(self):
+        '''
+        @return: Estimated seconds until the transfer finishes.
+        @rtype: float
+        '''
+
+        throughput = self.measuredThroughput() or self.throughput
+        return max(0, self.totalBytes - self.doneBytes) / throughput
+
+    def advance(self, count):
+        '''
+        Adds transferred bytes.
+
+        @param count: Amount of bytes.
+        '''
+
+        self.update(self.doneBytes + count)
+
+    def update(self, doneBytes):
+        '''
+        Sets the amount of transferred bytes. The bar is redrawn at most each PROGRESS_REFRESH_TIME seconds.
+
+        @param doneBytes: Amount of bytes transferred so far.
+        '''
+
+        self.doneBytes = doneBytes
+        now = time.time()
+        if now - self._lastRender >= PROGRESS_REFRESH_TIME or self.doneBytes >= self.totalBytes:
+            self._lastRender = now
+            self._render()
+
+    def message(self, text):
+        '''
+        Prints a line above the progress bar.
+
+        @param text: The message.
+        '''
+
+        self._clear()
+        self.output.write(text + "\n")
+        self._render()
+
+    def finish(self):
+        '''
+        Draws the bar for the last time and moves to the next line.
+
+        @return: Bytes per second of the whole transfer, or None if it was too short to be measured.
+        @rtype: float
+        '''
+
+        self._render()
+        if not self.onUpdate:
+            self.output.write("\n")
+            self.output.flush()
+        self._lineLength = 0
+        return self.measuredThroughput()
+
+    def _clear(self):
+
+        if self._lineLength:
+            self.output.write("\r" + " " * self._lineLength + "\r")
+            self._lineLength = 0
+
+    def _render(self):
+
+        doneBytes = min(self.doneBytes, self.totalBytes)
+        if self.onUpdate:
+            self.onUpdate(doneBytes, self.totalBytes, self.eta())
+            return
+
+        ratio = doneBytes / float(self.totalBytes) if self.totalBytes else 1.0
+        filled = int(ratio * PROGRESS_BAR_WIDTH)
+        line = "[{0}{1}] {2:3d}% {3:.1f}/{4:.1f} KB ETA {5}".format("#" * filled, "." * (PROGRESS_BAR_WIDTH - filled),
+                    int(ratio * 100), doneBytes / 1024.0, self.totalBytes / 1024.0, _formatTime(self.eta()))
+        self.output.write("\r" + line + " " * max(0, self._lineLength - len(line)))
+        self.output.flush()
+        self._lineLength = len(line)
+    
+
+def _isWordChar(char):
+    '''
+    Checks whether a character can't be next to another word without a space.
+    
+    @param char: The character. It can be empty.
+    @rtype: bool
+    '''
     
+    return char != "" and (char.isalnum() or char in "_\"'")
+
+
+def minifySource(source):
+    '''
+    Removes comments, docstrings and the redundant whitespace of a Python source.
+    The line numbers are kept, thus the tracebacks of the device still point to the right lines.
+
+    @param source: Python source code.
+    @return: The minified source code.
+    @rtype: str
+    '''
+
+    tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+    sourceLines = source.splitlines(True)
+    output = []
+    depth = 0
+    lastType = tokenize.NEWLINE
+    lastRow = 1
+    lastCol = 0
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        tokenType = token.type
+        if tokenType == tokenize.INDENT:
+            depth += 1
+        elif tokenType == tokenize.DEDENT:
+            depth -= 1
+        elif tokenType in (tokenize.COMMENT, tokenize.ENDMARKER):
+            pass
+        elif tokenType in (tokenize.NEWLINE, tokenize.NL):
+            if token.start[0] > lastRow:
+                #Backslash continuation, the line break must be kept
+                output.append(" \\\n" * (token.start[0] - lastRow))
+            output.append("\n")
+            lastRow = token.end[0] + 1
+            lastCol = 0
+        else:
+            text = token.string
+            end = token.end
+            if tokenType == getattr(tokenize, "FSTRING_START", None):
+                #The f-strings are copied as they are
+                level = 0
+                while True:
+                    if tokens[i].type == tokenize.FSTRING_START:
+                        level += 1
+                    elif tokens[i].type == tokenize.FSTRING_END:
+                        level -= 1
+                        if level == 0:
+                            break
+                    i += 1
+                end = tokens[i].end
+                if token.start[0] == end[0]:
+                    text = sourceLines[token.start[0] - 1][token.start[1]:end[1]]
+                else:
+                    text = sourceLines[token.start[0] - 1][token.start[1]:] \
+                        + "".join(sourceLines[token.start[0]:end[0] - 1]) \
+                        + sourceLines[end[0] - 1][:end[1]]
+            elif tokenType == tokenize.STRING and lastType in (tokenize.NEWLINE, tokenize.NL, tokenize.INDENT, tokenize.DEDENT) \
+                    and text.lstrip("rRbBuU")[:1] not in ("f", "F"):
+                #A string as a whole statement is a docstring. Before Python 3.12 the f-strings are
+                #STRING tokens too, but they are kept since their expressions are evaluated
+                nextToken = tokens[i + 1]
+                if nextToken.type == tokenize.COMMENT:
+                    nextToken = tokens[i + 2]
+                if nextToken.type in (tokenize.NEWLINE, tokenize.ENDMARKER):
+                    #Blocks can't be empty, but a "pass" could break a later "from __future__" import
+                    text = ("pass" if depth > 0 else "") + "\n" * (token.end[0] - token.start[0])
+
+            if token.start[0] > lastRow:
+                output.append(" \\\n" * (token.start[0] - lastRow))
+                lastCol = 0
+            if lastCol == 0:
+                if lastType in (tokenize.NEWLINE, tokenize.NL, tokenize.INDENT, tokenize.DEDENT):
+                    output.append(" " * depth)
+            elif token.start[1] > lastCol and (_isWordChar(output[-1][-1:]) and _isWordChar(text[:1])
+                    or lastType == tokenize.NUMBER and text[:1] == "."):
+                #"1 .real" can't be joined either, it would be read as a float
+                output.append(" ")
+            output.append(text)
+            lastRow = end[0]
+            lastCol = end[1]
+            lastType = tokenType
+            i += 1
+            continue
+
+        if tokenType not in (tokenize.COMMENT, tokenize.ENDMARKER):
+            lastType = tokenType
+        i += 1
+
+    return "".join(output)
+
+
+def _minifiedLines(localPath):
+    '''
+    Reads a Python source minified. The minified sources are cached by the hash of their contents
+    and the MINIFY_VERSION, hence a source is only minified once. The sources which can't be
+    tokenized are read as they are, so the device reports the error as without minifying.
+
+    @param localPath: Path to the source file.
+    @return: Lines of the minified source
+    @rtype: list
+    '''
+
+    with open(localPath, "rb") as f:
+        source = f.read()
+
+    cachePath = os.path.join(CACHE_DIR, "minify", MINIFY_VERSION, hashlib.sha256(source).hexdigest() + ".py")
+    if os.path.isfile(cachePath):
+        with open(cachePath, "r", encoding="utf8") as f:
+            return f.readlines()
+
+    try:
+        minified = minifySource(source.decode("utf8"))
+    except (tokenize.TokenError, SyntaxError, UnicodeDecodeError):
+        with open(localPath, "r") as f:
+            return f.readlines()
+
+    try:
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        with open(cachePath, "w", encoding="utf8") as f:
+            f.write(minified)
+    except OSError:
+        #The cache is optional
+        pass
+
+    return minified.splitlines(True)
 
-def flashTextFile(pybObj, localPath, remotePath, flushAfterLines, verbose):
+
+def flashTextFile(pybObj, localPath, remotePath, flushAfterLines, verbose, minify=False, progress=None, report=None):
     '''
     Copies a file to the remote device in text mode. If the destination path doesn't exist, it will be created.
     
@@ -191,17 +681,23 @@ def flashTextFile(pybObj, localPath, remotePath, flushAfterLines, verbose):
                        that means starting with "/".
     @param flushAfterLines: Flushes file after some lines.
     @param verbose: Flag to print some information about the process.
+    @param minify: (optional, default=False) Removes comments, docstrings and indentation of Python sources.
+    @param progress: (optional, default=None) Progress of the whole transfer. See TransferProgress.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
     '''
 
-    print("(text) {0} => {1}".format(localPath, remotePath))
+    _announce("(text) {0} => {1}".format(localPath, remotePath), progress, report)
     
     remotePath = remotePath.replace("\\","/")
     dirpath = os.path.dirname(remotePath)
-    createDirpath(pybObj, dirpath, verbose)
+    createDirpath(pybObj, dirpath, verbose, report)
 
-    f = open(localPath, "r")
-    lines = f.readlines()
-    f.close()
+    if minify and localPath.endswith(".py"):
+        lines = _minifiedLines(localPath)
+    else:
+        f = open(localPath, "r")
+        lines = f.readlines()
+        f.close()
     
     _exec(pybObj, "f = open('{0}', 'w')".format(remotePath))
     i = 0
@@ -209,192 +705,1957 @@ def flashTextFile(pybObj, localPath, remotePath, flushAfterLines, verbose):
     for line in lines[i:]:
         line = line.rstrip()
         i += 1
-        printVerbose("{0:04d} >{1}".format(i, line), verbose)
+        printVerbose("{0:04d} >{1}".format(i, line), verbose, report)
         line = line.replace("\'", "\\\'")
         line = line.replace("\"", "\\\"")
         line = line.replace("\\r", "\\\\r")
         line = line.replace("\\n", "\\\\n")
         _exec(pybObj, "f.write('{0}\\n')".format(line))
+        if progress:
+            progress.advance(len(lines[i - 1]))
             
         if i % flushAfterLines == 0:
             _exec(pybObj, "f.flush()")
             time.sleep(0.1)
-            if not verbose:
+            if not verbose and not progress:
                 print(".", end="", flush=True)
 
     _exec(pybObj, "f.flush()")
     _exec(pybObj, "f.close()")
-    if not verbose:
+    if not verbose and not progress:
         print("|")
 
 
-def flashBinaryFile(pybObj, localPath, remotePath, verbose):
+#On-device helpers for the binary copy. Every chunk carries its sequence number and its CRC32,
+#seeded with the sequence number, and it's only written when the CRC matches. The ports
+#without crc32 only rely on the base64 decoding and the hash of the whole file.
+BINARY_HELPERS_CODE = """
+import ubinascii
+_received = set()
+_crc32 = getattr(ubinascii, 'crc32', None)
+def _writeChunk(seq, data, crc):
+    try:
+        data = ubinascii.a2b_base64(data)
+    except ValueError:
+        return
+    if _crc32 is None or _crc32(data, seq) & 0xffffffff == crc:
+        f.seek(seq * {0})
+        f.write(data)
+        _received.add(seq)
+"""
+
+
+def _resync(pybObj):
+    '''
+    Recovers the raw REPL after a command was corrupted on the line. The interrupted
+    command is discarded, but the state of the device is preserved.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    '''
+
+    pybObj.serial.write(b"\r\x03")
+    time.sleep(0.1)
+    pybObj.pending = b""
+    n = pybObj.serial.inWaiting()
+    while n > 0:
+        pybObj.serial.read(n)
+        n = pybObj.serial.inWaiting()
+
+    pybObj.serial.write(b"\r\x01")
+    data = pybObj.read_until(1, b"raw REPL; CTRL-B to exit\r\n")
+    if not data.endswith(b"raw REPL; CTRL-B to exit\r\n"):
+        raise PyboardError("could not resynchronize the raw repl")
+
+
+def flashBinaryFile(pybObj, localPath, remotePath, verbose, progress=None, report=None):
     '''
     Copies a file to the remote device in binary mode. If the destination path doesn't exist, it will be created.
-    
+    The file is sent in chunks with sequence number and CRC32. The device only writes the right ones,
+    and the missing chunks are sent again, up to BINARY_RETRIES times. Finally the hash of the whole
+    file is checked, and it's sent again if it doesn't match.
+
     @param pybObj: Interface with the remote device. Must be initializated previously.
     @param localPath: Path to the source file.
-    @param remotePath: Path of the destination file. This path must be absolute, 
+    @param remotePath: Path of the destination file. This path must be absolute,
                        that means starting with "/".
     @param verbose: Flag to print some information about the process.
+    @param progress: (optional, default=None) Progress of the whole transfer. See TransferProgress.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
     '''
-    
-    print("(binary) {0} => {1}".format(localPath, remotePath))
-    
+
+    _announce("(binary) {0} => {1}".format(localPath, remotePath), progress, report)
+
     dirpath = os.path.dirname(remotePath)
-    createDirpath(pybObj, dirpath, verbose)
+    createDirpath(pybObj, dirpath, verbose, report)
 
     with open(localPath, "rb") as f:
-        
-        _exec(pybObj, "f = open('{0}', 'wb')".format(remotePath))
-        
-        buffer = bytes(f.read(BINARY_BUFFER_SIZE))
-        while len(buffer) > 0:                   
-            _exec(pybObj, "f.write({0})".format(str(buffer)))
-            _exec(pybObj, "f.flush()")
-            buffer = bytes(f.read(BINARY_BUFFER_SIZE))
-            if not verbose:
+        contents = f.read()
+    chunkCount = (len(contents) + BINARY_BUFFER_SIZE - 1) // BINARY_BUFFER_SIZE
+
+    pybObj.exec("f = open('{0}', 'wb')".format(remotePath))
+    pybObj.exec(BINARY_HELPERS_CODE.format(BINARY_BUFFER_SIZE))
+
+    missing = list(range(chunkCount))
+    retries = 0
+    while missing:
+        for seq in missing:
+            chunk = contents[seq * BINARY_BUFFER_SIZE:(seq + 1) * BINARY_BUFFER_SIZE]
+            data = binascii.b2a_base64(chunk).decode("ascii").strip()
+            try:
+                _exec(pybObj, "_writeChunk({0}, '{1}', {2})".format(seq, data, binascii.crc32(chunk, seq)))
+            except PyboardError as error:
+                printVerbose("Chunk {0} failed: {1}".format(seq, error), verbose, report)
+                _resync(pybObj)
+            if progress:
+                progress.advance(len(chunk))
+            elif not verbose:
                 print(".", end="", flush=True)
             else:
-                print(buffer)
-        
-        _exec(pybObj, "f.close()")
-        if not verbose:
-            print("|")
-        f.close()
+                _report("Chunk {0}/{1}".format(seq + 1, chunkCount), report)
+
+        query = "[seq for seq in range({0}) if seq not in _received]".format(chunkCount)
+        try:
+            missing = remoteEval(pybObj, query)
+        except (PyboardError, ValueError, SyntaxError) as error:
+            printVerbose("Query of the missing chunks failed: {0}".format(error), verbose, report)
+            _resync(pybObj)
+            missing = remoteEval(pybObj, query)
+        if not missing:
+            pybObj.exec("f.flush()")
+            if remoteHashes(pybObj, [remotePath]) != [localHash(localPath)]:
+                printVerbose("Hash of '{0}' doesn't match".format(remotePath), verbose, report)
+                pybObj.exec("_received.clear()")
+                missing = list(range(chunkCount))
+        if missing:
+            retries += 1
+            if retries > BINARY_RETRIES:
+                pybObj.exec("f.close()")
+                raise PyboardError("could not copy '{0}', {1} chunks failed".format(localPath, len(missing)))
+            printVerbose("Sending {0} chunks again".format(len(missing)), verbose, report)
+
+    pybObj.exec("f.close()")
+    pybObj.exec("del _received, _crc32, _writeChunk")
+    if not verbose and not progress:
+        print("|")
 
 
-def eraseDir(pybObj, remotePath, verbose):
+#On-device routine which prints the checksums of the fixed-size blocks of a remote file,
+#or None if the file doesn't exist. Every block has a weak checksum, which is the sum of its 
+#bytes, and a strong one, which is a truncated SHA-256 hash.
+REMOTE_BLOCK_HASHES_CODE = """
+import uhashlib, ubinascii
+def _blockHashes(path, blockSize):
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    hashes = []
+    buffer = f.read(blockSize)
+    while buffer:
+        hashes.append((sum(buffer), ubinascii.hexlify(uhashlib.sha256(buffer).digest()[:8]).decode()))
+        buffer = f.read(blockSize)
+    f.close()
+    return hashes
+print(repr(_blockHashes({0!r}, {1})))
+del _blockHashes
+"""
+
+#On-device helpers which rebuild a file from the blocks of the old one and new data.
+DELTA_HELPERS_CODE = """
+import ubinascii
+def _copyBlocks(block, count):
+    _src.seek(block * {0})
+    for i in range(count):
+        _dst.write(_src.read({0}))
+def _writeData(data):
+    _dst.write(ubinascii.a2b_base64(data))
+"""
+
+
+def _deltaInstructions(data, remoteBlockHashes):
     '''
-    Erases a directory on the remote device. This function is recursive and all contents, 
-    files and directories within the target directory will be also erased.
+    Finds the blocks of the remote file within the new contents, at any offset, 
+    the way rsync does.
     
-    @param pybObj: Interface with the remote device. Must be initializated previously.
-    @param remotePath: Path of the remote directory. This path must be absolute, 
-                       that means starting with "/".
-    @param verbose: Flag to print some information about the process.
+    @param data: New contents of the file.
+    @param remoteBlockHashes: Checksums of the blocks of the remote file, as (weak, strong) tuples.
+    @return: Instructions to rebuild the file, as ("copy", first block, number of blocks) and
+             ("data", bytes) tuples.
+    @rtype: list
     '''
 
-    itemNames = remoteEval(pybObj,"os.listdir('{0}')".format(remotePath))
-    for itemName in itemNames:
-        itemPath = remotePath + '/' + itemName
-        if remotePathIsFile(pybObj, itemPath):
-            print("Deleting file '{0}'".format(itemPath))
-            pybObj.exec("os.remove('{0}')".format(itemPath))
+    #A short last block never matches a whole window, so all the blocks can be indexed.
+    #The short one can only be found at the end, see below.
+    remoteBlocks = {}
+    for i, (weak, strong) in enumerate(remoteBlockHashes):
+        remoteBlocks.setdefault(weak, {}).setdefault(strong, i)
+    
+    instructions = []
+    
+    def addCopy(block):
+        last = instructions[-1] if instructions else None
+        if last and last[0] == "copy" and last[1] + last[2] == block:
+            instructions[-1] = ("copy", last[1], last[2] + 1)
+        else:
+            instructions.append(("copy", block, 1))
+    
+    dataStart = 0
+    offset = 0
+    weak = sum(data[0:DELTA_BLOCK_SIZE])
+    while offset + DELTA_BLOCK_SIZE <= len(data):
+        block = None
+        candidates = remoteBlocks.get(weak)
+        if candidates:
+            block = candidates.get(hashlib.sha256(data[offset:offset + DELTA_BLOCK_SIZE]).hexdigest()[:16])
+        if block is not None:
+            if dataStart < offset:
+                instructions.append(("data", data[dataStart:offset]))
+            addCopy(block)
+            offset += DELTA_BLOCK_SIZE
+            dataStart = offset
+            weak = sum(data[offset:offset + DELTA_BLOCK_SIZE])
         else:
-            eraseDir(pybObj, itemPath, verbose)
+            if offset + DELTA_BLOCK_SIZE < len(data):
+                weak += data[offset + DELTA_BLOCK_SIZE] - data[offset]
+            offset += 1
     
-    print("Deleting directory '{0}'".format(remotePath))
-    pybObj.exec("os.rmdir('{0}')".format(remotePath))
+    tail = data[dataStart:]
+    if tail and remoteBlockHashes and len(tail) < DELTA_BLOCK_SIZE \
+            and remoteBlockHashes[-1] == (sum(tail), hashlib.sha256(tail).hexdigest()[:16]):
+        addCopy(len(remoteBlockHashes) - 1)
+    elif tail:
+        instructions.append(("data", tail))
     
+    return instructions
+
 
-def flashDir(pybObj, localPath, remotePath, forceBinary, flushAfterLines, verbose):
+def flashBinaryFileDelta(pybObj, localPath, remotePath, verbose, progress=None, report=None):
     '''
-    Copies a directory on the remote device. This function is recursive and all contents, 
-    files and directories within the target directory will be copied too, but files with the 
-    pattern '*.pyc' and directories '__pycache__', which are ignored and therefore 
-    they won't be copied.
-    
+    Copies a file to the remote device in binary mode, sending only the blocks which differ from
+    the already existing remote file. The file is rebuilt in a temporary file which replaces the
+    old one at the end. If the remote file doesn't exist, the whole file is copied.
+
     @param pybObj: Interface with the remote device. Must be initializated previously.
-    @param localPath: Path to the source directory.
-    @param remotePath: Path of the remote directory. This path must be absolute, 
+    @param localPath: Path to the source file.
+    @param remotePath: Path of the destination file. This path must be absolute,
                        that means starting with "/".
-    @forceBinary: Forces files to be copied in binary mode
-    @flushAfterLines: Flushes text files after some lines. It is ignored for binary files.
     @param verbose: Flag to print some information about the process.
+    @param progress: (optional, default=None) Progress of the whole transfer. See TransferProgress.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
     '''
 
-    for itemName in os.listdir(localPath):
-        itemLocalPath = "{0}/{1}".format(localPath, itemName)
-        itemRemotePath = "{0}/{1}".format(remotePath, itemName)
-        if os.path.isfile(itemLocalPath) and not itemName.endswith(".pyc"):
-            if not forceBinary and itemName.endswith(TEXT_FILES):
-                flashTextFile(pybObj, itemLocalPath, itemRemotePath, flushAfterLines, verbose)
-            else:
-                flashBinaryFile(pybObj, itemLocalPath, itemRemotePath, verbose)
-        elif os.path.isdir(itemLocalPath) and itemName != "__pycache__":
-            flashDir(pybObj, itemLocalPath, itemRemotePath, forceBinary, flushAfterLines, verbose)
+    result = pybObj.exec(REMOTE_BLOCK_HASHES_CODE.format(remotePath, DELTA_BLOCK_SIZE))
+    remoteBlockHashes = ast.literal_eval(result.decode("ascii").strip())
+    if remoteBlockHashes is None:
+        flashBinaryFile(pybObj, localPath, remotePath, verbose, progress, report)
+        return
+
+    _announce("(delta) {0} => {1}".format(localPath, remotePath), progress, report)
+
+    with open(localPath, "rb") as f:
+        instructions = _deltaInstructions(f.read(), remoteBlockHashes)
+    dataSize = sum(len(instruction[1]) for instruction in instructions if instruction[0] == "data")
+    printVerbose("{0} bytes to be sent".format(dataSize), verbose, report)
+    if dataSize == 0 and len(instructions) == 1 and instructions[0][1:] == (0, len(remoteBlockHashes)):
+        printVerbose("File unchanged", verbose, report)
+        if progress:
+            progress.advance(os.path.getsize(localPath))
+        return
+
+    tempPath = remotePath + ".tmp"
+    pybObj.exec(DELTA_HELPERS_CODE.format(DELTA_BLOCK_SIZE))
+    pybObj.exec("_src = open('{0}', 'rb')".format(remotePath))
+    pybObj.exec("_dst = open('{0}', 'wb')".format(tempPath))
+    for instruction in instructions:
+        if instruction[0] == "copy":
+            printVerbose("Copy {1} blocks from block {0}".format(*instruction[1:]), verbose, report)
+            _exec(pybObj, "_copyBlocks({0}, {1})".format(*instruction[1:]))
+            if progress:
+                progress.advance(instruction[2] * DELTA_BLOCK_SIZE)
         else:
-            printVerbose("Item '{0}' ignored".format(itemLocalPath), verbose)
-            
+            data = instruction[1]
+            printVerbose("Write {0} bytes".format(len(data)), verbose, report)
+            for offset in range(0, len(data), DELTA_DATA_SIZE):
+                _exec(pybObj, "_writeData('{0}')".format(binascii.b2a_base64(data[offset:offset + DELTA_DATA_SIZE]).decode("ascii").strip()))
+                if progress:
+                    progress.advance(len(data[offset:offset + DELTA_DATA_SIZE]))
+                elif not verbose:
+                    print(".", end="", flush=True)
+    pybObj.exec("_src.close()")
+    pybObj.exec("_dst.close()")
+    pybObj.exec("os.remove('{0}')".format(remotePath))
+    pybObj.exec("os.rename('{0}', '{1}')".format(tempPath, remotePath))
+    pybObj.exec("del _src, _dst, _copyBlocks, _writeData")
+    if not verbose and not progress:
+        print("|")
 
-def flash(pybObj, localPath, remotePath, erase, forceBinary, flushAfterLines, verbose):
+    if remoteHashes(pybObj, [remotePath])[0] != localHash(localPath):
+        _announce("Delta transfer of '{0}' failed. Copying the whole file.".format(localPath), progress, report)
+        flashBinaryFile(pybObj, localPath, remotePath, verbose, progress, report)
+
+
+#On-device routine for the recursive erase. It runs as a single command, so the whole tree
+#is removed without a round trip per item. It prints the number of erased items and the
+#list of failures as (path, error) tuples.
+ERASE_DIR_CODE = """
+import os
+def _eraseDir(path, keep, failures):
+    count = 0
+    for itemName in os.listdir(path):
+        itemPath = path + '/' + itemName
+        if itemPath in keep:
+            continue
+        try:
+            if os.stat(itemPath)[0] & 0x4000:
+                count += _eraseDir(itemPath, keep, failures)
+            else:
+                os.remove(itemPath)
+                count += 1
+        except Exception as e:
+            failures.append((itemPath, repr(e)))
+    for keepPath in keep:
+        if keepPath.startswith(path + '/'):
+            return count
+    try:
+        os.rmdir(path)
+        count += 1
+    except Exception as e:
+        failures.append((path, repr(e)))
+    return count
+_failures = []
+_count = _eraseDir({0!r}, {1!r}, _failures)
+print(repr((_count, _failures)))
+del _eraseDir, _failures, _count
+"""
+
+
+def eraseDir(pybObj, remotePath, verbose, keepPaths=(), report=None):
     '''
-    Executes the flash functionality.
-    Ask the user for confirmation.
-    In case of positive confirmation, copies a single file or a directory recursively to the 
-    remote device. Already flashed contents can be preserved or erased as desired.
+    Erases a directory on the remote device. This function is recursive and all contents, 
+    files and directories within the target directory will be also erased.
+    The erase routine is executed on the device in a single command.
     
     @param pybObj: Interface with the remote device. Must be initializated previously.
-    @param remotePath: Path where the code will be copied within.
-    @param localPath: Path to the source file or directory.
-    @param erase: Flag to preserve or erase already flashed contents.
-    @param forceBinary: Forces files to be copied in binary mode
-    @param flushAfterLines: Flushes text files after some lines. It is ignored for binary files.
+    @param remotePath: Path of the remote directory. This path must be absolute, 
+                       that means starting with "/".
     @param verbose: Flag to print some information about the process.
+    @param keepPaths: (optional, default=()) Paths which won't be erased. They can be absolute 
+                      or relative to the remote directory. The directories containing them 
+                      are preserved too.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
+    @return: Number of erased items and the list of failures as (path, error) tuples.
     '''
 
-    answer = input("The contents of MCU will be changed. Are you sure to proceed? (Y/n): ");
-    if answer and answer.startswith("Y"):
+    remotePath = remotePath.replace("\\", "/").rstrip("/")
+    keep = []
+    for keepPath in keepPaths:
+        keepPath = keepPath.replace("\\", "/").rstrip("/")
+        if not keepPath.startswith("/"):
+            keepPath = remotePath + "/" + keepPath
+        keep.append(keepPath)
+    
+    if keep:
+        _report("Deleting directory '{0}', but {1} kept paths".format(remotePath, len(keep)), report)
+    else:
+        _report("Deleting directory '{0}'".format(remotePath), report)
+    result, resultError = pybObj.exec_raw(ERASE_DIR_CODE.format(remotePath, tuple(keep)), timeout=None)
+    if resultError:
+        raise PyboardError("exception", result, resultError)
+    count, failures = ast.literal_eval(result.decode("ascii").strip())
+    printVerbose("{0} items deleted".format(count), verbose, report)
+    for path, error in failures:
+        _report("Could not delete '{0}': {1}".format(path, error), report)
+    
+    return count, failures
+    
 
-        if erase:
-            _doEraseAll(pybObj, verbose)
-        
-        remotePath = "/" + remotePath if remotePath != "" else ""
-        
-        if os.path.isfile(localPath):
-            filename = localPath.split("/")[-1]
-            fullRemotePath = "/flash/" + APP_DIR_NAME + remotePath + "/{0}".format(filename)
-            if not forceBinary and filename.endswith(TEXT_FILES):
-                flashTextFile(pybObj, localPath, fullRemotePath, flushAfterLines, verbose)
+def _ignorePatternRegex(pattern):
+    '''
+    Translates a gitignore pattern into a regular expression.
+
+    @param pattern: The pattern, without negation nor trailing slash.
+    @return: Regular expression matching the relative paths, with "/" as separator.
+    @rtype: str
+    '''
+
+    #Patterns with a slash are relative to the root, otherwise they match at any level
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+            continue
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+        elif char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex += "\\["
             else:
-                flashBinaryFile(pybObj, localPath, fullRemotePath, verbose)
+                charClass = pattern[i + 1:end]
+                if charClass.startswith("!"):
+                    charClass = "^" + charClass[1:]
+                regex += "[" + charClass.replace("\\", "\\\\") + "]"
+                i = end
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
         else:
-            dirname = localPath.rstrip("/").split("/")[-1]
-            fullRemotePath = "/flash/" + APP_DIR_NAME + remotePath + (("/" + dirname) if dirname != "." else "")
-            flashDir(pybObj, localPath, fullRemotePath, forceBinary, flushAfterLines, verbose)
+            regex += re.escape(char)
+        i += 1
 
-        print("Done. User code is available under the '" + APP_DIR_NAME + "' directory.")
-        
-    else:
-        print("Aborted.")
+    return ("^" if anchored else "^(?:.*/)?") + regex + "$"
 
 
-def _doEraseAll(pybObj, verbose):
+def compileIgnoreRules(rootPath, patterns):
     '''
-    Erases all user code on the remote device.
-    
-    @param pybObj: Interface with the remote device. Must be initializated previously.
-    @param verbose: Flag to print some information about the process.
+    Compiles gitignore-style rules into a matcher. As in gitignore, the last matching rule wins
+    and a pattern starting with "!" includes again the matching items.
+
+    @param rootPath: Path to the local directory the patterns are relative to.
+    @param patterns: Lines of the rules. Blank lines and comments starting with "#" are skipped.
+    @return: Function which receives a local path and whether it is a directory, and returns
+             True when the item has to be ignored.
+    @rtype: function
     '''
 
-    existModules = remoteEval(pybObj, "'flash' in os.listdir('/') and '" + APP_DIR_NAME + "' in os.listdir('/flash')")
-    if existModules:
-        eraseDir(pybObj, "/flash/" + APP_DIR_NAME, verbose)
+    rules = []
+    for pattern in patterns:
+        pattern = pattern.rstrip("\r\n")
+        if pattern.endswith("\\ "):
+            pattern = pattern.rstrip() + " "
+        else:
+            pattern = pattern.rstrip()
+        if pattern == "" or pattern.startswith("#"):
+            continue
+        negated = pattern.startswith("!")
+        if negated or pattern.startswith("\\!") or pattern.startswith("\\#"):
+            pattern = pattern[1:]
+        dirOnly = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        rules.append((re.compile(_ignorePatternRegex(pattern)).match, negated, dirOnly))
+    rules.reverse()
+
+    rootPath = os.path.normpath(rootPath)
+
+    def isIgnored(localPath, isDir):
+        relPath = os.path.relpath(os.path.normpath(localPath), rootPath).replace(os.sep, "/")
+        for match, negated, dirOnly in rules:
+            if (isDir or not dirOnly) and match(relPath):
+                return not negated
+        return False
+
+    return isIgnored
+
+
+def readIgnoreRules(localPath, excludes=(), includes=()):
+    '''
+    Builds the matcher of the items which won't be flashed. The rules are, in this order, the
+    DEFAULT_IGNORE_RULES, the contents of the IGNORE_FILE_NAME file of the local directory, the
+    excluding patterns and the including patterns.
+
+    @param localPath: Path to the source directory.
+    @param excludes: (optional, default=()) Patterns of the items to be ignored.
+    @param includes: (optional, default=()) Patterns of the items to be flashed anyway.
+    @return: Matcher function. See compileIgnoreRules.
+    @rtype: function
+    '''
 
+    patterns = list(DEFAULT_IGNORE_RULES)
+    ignoreFilePath = os.path.join(localPath, IGNORE_FILE_NAME)
+    if os.path.isfile(ignoreFilePath):
+        with open(ignoreFilePath, "r") as f:
+            patterns += f.readlines()
+    patterns += excludes
+    patterns += ["!" + pattern for pattern in includes]
 
-def eraseAll(pybObj, verbose):
+    return compileIgnoreRules(localPath if os.path.isdir(localPath) else os.path.dirname(localPath), patterns)
+
+
+def _walkLocalFiles(localPath, remotePath, isIgnored=None):
     '''
-    Executes the "erase" option.
-    Ask the user for confirmation.
-    In case of positive confirmation, it erases all user code on the remote device.
-    
-    @param pybObj: Interface with the remote device. Must be initializated previously.
-    @param verbose: Flag to print some information about the process.
+    Lists the files within a local path which are flashed. The ignored directories
+    are skipped as a whole.
+
+    @param localPath: Path to the source file or directory.
+    @param remotePath: Path of the destination within the device.
+    @param isIgnored: (optional, default=None) Matcher of the items which won't be flashed.
+                      See compileIgnoreRules. If None, only the DEFAULT_IGNORE_RULES are applied.
+    @return: Tuples as (local path, remote path) for every file to be flashed.
+    @rtype: list
     '''
 
-    existModules = remoteEval(pybObj, "'flash' in os.listdir('/') and '" + APP_DIR_NAME + "' in os.listdir('/flash')")
-    if existModules:
-        answer = input("The user code will be erased. Are you sure to proceed? (Y/n): ");
-        if answer and answer.startswith("Y"):
-            _doEraseAll(pybObj, verbose)
-            _doClearMain(pybObj)
-            print("Done.")
-        else:
-            print("Aborted.")
-    else:
-        print("The device has no user code flashed. Aborting.")
-        
+    if os.path.isfile(localPath):
+        return [(localPath, remotePath)]
+
+    if isIgnored is None:
+        isIgnored = compileIgnoreRules(localPath, DEFAULT_IGNORE_RULES)
+
+    files = []
+    for itemName in os.listdir(localPath):
+        itemLocalPath = "{0}/{1}".format(localPath, itemName)
+        itemRemotePath = "{0}/{1}".format(remotePath, itemName)
+        isDir = os.path.isdir(itemLocalPath)
+        if isIgnored(itemLocalPath, isDir):
+            continue
+        elif isDir:
+            files += _walkLocalFiles(itemLocalPath, itemRemotePath, isIgnored)
+        elif os.path.isfile(itemLocalPath):
+            files.append((itemLocalPath, itemRemotePath))
+
+    return files
+
+
+def _fullRemotePath(localPath, remotePath):
+    '''
+    Gets the path on the device where a local file or directory is flashed to.
+
+    @param localPath: Path to the source file or directory.
+    @param remotePath: Path within the user code directory where the code will be copied into.
+    @return: Absolute path on the device
+    @rtype: str
+    '''
+
+    remotePath = "/" + remotePath if remotePath != "" else ""
+    if os.path.isfile(localPath):
+        filename = localPath.split("/")[-1]
+        return "/flash/" + APP_DIR_NAME + remotePath + "/{0}".format(filename)
+    else:
+        dirname = localPath.rstrip("/").split("/")[-1]
+        return "/flash/" + APP_DIR_NAME + remotePath + (("/" + dirname) if dirname != "." else "")
+
+
+def dryRun(localPath, remotePath, isIgnored=None):
+    '''
+    Executes the "dry run" option.
+    Lists the files which would be flashed, with their sizes, without accessing the device.
+
+    @param localPath: Path to the source file or directory.
+    @param remotePath: Path within the user code directory where the code will be copied into.
+    @param isIgnored: (optional, default=None) Matcher of the items which won't be flashed.
+                      See compileIgnoreRules.
+    '''
+
+    totalSize = 0
+    files = _walkLocalFiles(localPath, _fullRemotePath(localPath, remotePath), isIgnored)
+    for itemLocalPath, itemRemotePath in files:
+        size = os.path.getsize(itemLocalPath)
+        totalSize += size
+        print("{0:>10} {1} => {2}".format(size, itemLocalPath, itemRemotePath))
+
+    print("{0} files, {1} bytes.".format(len(files), totalSize))
+
+
+def _flashFile(pybObj, localPath, remotePath, forceBinary, flushAfterLines, verbose, delta=False, minify=False, progress=None, report=None):
+    '''
+    Copies a file to the remote device in the mode according to its type.
+    
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param localPath: Path to the source file.
+    @param remotePath: Path of the destination file. This path must be absolute, 
+                       that means starting with "/".
+    @forceBinary: Forces files to be copied in binary mode
+    @flushAfterLines: Flushes text files after some lines. It is ignored for binary files.
+    @param verbose: Flag to print some information about the process.
+    @param delta: (optional, default=False) Sends only the changed blocks of binary files.
+    @param minify: (optional, default=False) Removes comments, docstrings and indentation of Python sources.
+    @param progress: (optional, default=None) Progress of the whole transfer. See TransferProgress.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
+    '''
+
+    if not forceBinary and localPath.endswith(TEXT_FILES):
+        flashTextFile(pybObj, localPath, remotePath, flushAfterLines, verbose, minify, progress, report)
+    elif delta:
+        flashBinaryFileDelta(pybObj, localPath, remotePath, verbose, progress, report)
+    else:
+        flashBinaryFile(pybObj, localPath, remotePath, verbose, progress, report)
+
+
+#On-device helper which writes a whole file at once, used for batching the small files.
+#As with the binary copy, every file carries its CRC32 and it's only written when it matches.
+#The written files are recorded, so the failed ones can be sent again.
+SMALL_FILES_CODE = """
+import ubinascii
+_written = set()
+_crc32 = getattr(ubinascii, 'crc32', None)
+def _writeFile(path, data, crc):
+    try:
+        data = ubinascii.a2b_base64(data)
+    except ValueError:
+        return
+    if _crc32 is None or _crc32(data) & 0xffffffff == crc:
+        with open(path, 'wb') as f:
+            f.write(data)
+        _written.add(path)
+"""
+
+
+def planTransfer(localPath, remotePath, isIgnored=None):
+    '''
+    Builds the list of work of a transfer: the directories to be created and the files
+    to be copied, with their sizes. The files are sorted from the smallest to the largest one.
+
+    @param localPath: Path to the source file or directory.
+    @param remotePath: Path of the destination within the device. This path must be absolute,
+                       that means starting with "/".
+    @param isIgnored: (optional, default=None) Matcher of the items which won't be flashed.
+                      See compileIgnoreRules.
+    @return: The remote directories, sorted so the parents come first, and the files as
+             (local path, remote path, size) tuples.
+    @rtype: tuple
+    '''
+
+    files = []
+    directories = set()
+    for itemLocalPath, itemRemotePath in _walkLocalFiles(localPath, remotePath, isIgnored):
+        files.append((itemLocalPath, itemRemotePath, os.path.getsize(itemLocalPath)))
+        directories.add(os.path.dirname(itemRemotePath))
+    files.sort(key=lambda item: item[2])
+
+    return sorted(directories), files
+
+
+def remoteFreeSpace(pybObj):
+    '''
+    Queries the free space of the /flash filesystem of the remote device.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @return: Free bytes and the size of the blocks of the filesystem.
+    @rtype: tuple
+    '''
+
+    stat = remoteEval(pybObj, "os.statvfs('/flash')")
+    blockSize = stat[1] or stat[0]
+    return stat[4] * blockSize, blockSize
+
+
+def checkFreeSpace(pybObj, directories, files, erase, verbose, keepPaths=(), delta=False, report=None):
+    '''
+    Checks whether the files of a transfer fit into the remote device. The space of the
+    remote files which are erased or replaced is taken into account, and every file and
+    directory is rounded up to whole blocks. Delta transfers rebuild the files in a temporary
+    copy, so the space of the largest file is required on top.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param directories: Remote directories of the transfer. See planTransfer.
+    @param files: Files of the transfer. See planTransfer.
+    @param erase: Flag to indicate whether the user code is erased before copying.
+    @param verbose: Flag to print some information about the process.
+    @param keepPaths: (optional, default=()) Paths which won't be erased. See eraseDir.
+    @param delta: (optional, default=False) Whether the binary files are sent by delta transfer.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
+    @return: Required bytes and available bytes.
+    @rtype: tuple
+    '''
+
+    freeSpace, blockSize = remoteFreeSpace(pybObj)
+    roundUp = lambda size: (size + blockSize - 1) // blockSize * blockSize
+
+    appPath = "/flash/" + APP_DIR_NAME
+    existingFiles = []
+    if remoteEval(pybObj, "'" + APP_DIR_NAME + "' in os.listdir('/flash')"):
+        existingFiles = remoteFiles(pybObj, appPath)
+
+    if erase:
+        keep = []
+        for keepPath in keepPaths:
+            keepPath = keepPath.replace("\\", "/").rstrip("/")
+            keep.append(keepPath if keepPath.startswith("/") else appPath + "/" + keepPath)
+        isReclaimed = lambda path: not any(path == keepPath or path.startswith(keepPath + "/") for keepPath in keep)
+    else:
+        replacedPaths = set(itemRemotePath for _, itemRemotePath, _ in files)
+        isReclaimed = lambda path: path in replacedPaths
+    reclaimedSpace = sum(roundUp(size) for path, size in existingFiles if isReclaimed(path))
+
+    requiredSpace = sum(roundUp(size) for _, _, size in files) + blockSize * len(directories)
+    if delta and files:
+        requiredSpace += roundUp(files[-1][2])
+
+    printVerbose("Free space: {0} bytes, reclaimed: {1} bytes, required: {2} bytes".format(freeSpace, reclaimedSpace, requiredSpace), verbose, report)
+    return requiredSpace, freeSpace + reclaimedSpace
+
+
+def _flashedContents(localPath, forceBinary, minify=False):
+    '''
+    Reads a file as it's written on the device. Text files are written line by line without
+    the trailing whitespace, as flashTextFile does.
+
+    @param localPath: Path to the source file.
+    @param forceBinary: Flag to take the file as binary, whatever its type is.
+    @param minify: (optional, default=False) Removes comments, docstrings and indentation of Python sources.
+    @rtype: bytes
+    '''
+
+    if not forceBinary and localPath.endswith(TEXT_FILES):
+        if minify and localPath.endswith(".py"):
+            lines = _minifiedLines(localPath)
+        else:
+            with open(localPath, "r") as f:
+                lines = f.readlines()
+        return "".join(line.rstrip() + "\n" for line in lines).encode("utf8")
+
+    with open(localPath, "rb") as f:
+        return f.read()
+
+
+def flashSmallFiles(pybObj, files, forceBinary, verbose, minify=False, progress=None, report=None):
+    '''
+    Copies several small files to the remote device, batched in commands of about
+    SMALL_FILES_BATCH_SIZE bytes. Their directories must exist already.
+    The files which fail are sent again one by one, up to BINARY_RETRIES times.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param files: Files as (local path, remote path, size) tuples. See planTransfer.
+    @param forceBinary: Forces files to be copied in binary mode
+    @param verbose: Flag to print some information about the process.
+    @param minify: (optional, default=False) Removes comments, docstrings and indentation of Python sources.
+    @param progress: (optional, default=None) Progress of the whole transfer. See TransferProgress.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
+    '''
+
+    if not files:
+        return
+
+    pybObj.exec(SMALL_FILES_CODE)
+    pending = files
+    retries = 0
+    while pending:
+        commands = []
+        batchSize = 0
+        batchBytes = 0
+        for i, (itemLocalPath, itemRemotePath, size) in enumerate(pending):
+            if retries == 0:
+                _announce("(batch) {0} => {1}".format(itemLocalPath, itemRemotePath), progress, report)
+            contents = _flashedContents(itemLocalPath, forceBinary, minify)
+            data = binascii.b2a_base64(contents).decode("ascii").strip()
+            commands.append("_writeFile({0!r}, '{1}', {2})".format(itemRemotePath, data, binascii.crc32(contents)))
+            batchSize += len(data)
+            batchBytes += size
+            #The files are sent again one by one, so a failing file doesn't drag down the rest
+            if batchSize >= SMALL_FILES_BATCH_SIZE or retries > 0 or i == len(pending) - 1:
+                printVerbose("Writing {0} files".format(len(commands)), verbose, report)
+                try:
+                    pybObj.exec("\n".join(commands))
+                except PyboardError as error:
+                    printVerbose("Batch failed: {0}".format(error), verbose, report)
+                    _resync(pybObj)
+                if progress and retries == 0:
+                    progress.advance(batchBytes)
+                commands = []
+                batchSize = 0
+                batchBytes = 0
+
+        written = set(remoteEval(pybObj, "list(_written)"))
+        pending = [item for item in pending if item[1] not in written]
+        if pending:
+            retries += 1
+            for itemLocalPath, itemRemotePath, _ in pending:
+                _announce("Copy of '{0}' failed".format(itemLocalPath), progress, report)
+            if retries > BINARY_RETRIES:
+                pybObj.exec("del _written, _crc32, _writeFile")
+                raise PyboardError("could not copy {0} files".format(len(pending)))
+            printVerbose("Sending {0} files again".format(len(pending)), verbose, report)
+    pybObj.exec("del _written, _crc32, _writeFile")
+
+
+def _transferFiles(pybObj, directories, files, forceBinary, flushAfterLines, verbose, delta=False, minify=False, onProgress=None, report=None):
+    '''
+    Copies the planned files to the remote device. The directories are created first, the small
+    files are batched and the rest are copied from the smallest to the largest one, showing the
+    progress in bytes. The measured throughput is stored for later estimations.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param directories: Remote directories to be created. See planTransfer.
+    @param files: Files to be copied. See planTransfer.
+    @param forceBinary: Forces files to be copied in binary mode
+    @param flushAfterLines: Flushes text files after some lines. It is ignored for binary files.
+    @param verbose: Flag to print some information about the process.
+    @param delta: (optional, default=False) Sends only the changed blocks of binary files.
+    @param minify: (optional, default=False) Removes comments, docstrings and indentation of Python sources.
+    @param onProgress: (optional, default=None) Function which receives the progress instead of
+                       drawing the progress bar. See TransferProgress.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
+    @return: Seconds spent.
+    @rtype: float
+    '''
+
+    totalBytes = sum(size for _, _, size in files)
+    throughput = loadThroughput(pybObj)
+    _report("{0} files, {1} bytes. Estimated time: {2}".format(len(files), totalBytes,
+            _formatTime(totalBytes / (throughput or DEFAULT_THROUGHPUT))), report)
+
+    startTime = time.time()
+    createDirpaths(pybObj, directories, verbose, report)
+
+    progress = None if verbose and not onProgress else TransferProgress(totalBytes, throughput, onUpdate=onProgress)
+    smallFiles = [item for item in files if item[2] <= SMALL_FILE_SIZE]
+    flashSmallFiles(pybObj, smallFiles, forceBinary, verbose, minify, progress, report)
+    for itemLocalPath, itemRemotePath, size in files[len(smallFiles):]:
+        doneBytes = progress.doneBytes if progress else 0
+        _flashFile(pybObj, itemLocalPath, itemRemotePath, forceBinary, flushAfterLines, verbose, delta, minify, progress, report)
+        if progress:
+            #The bytes sent don't match the size of the file, i.e. text files are stripped
+            progress.update(doneBytes + size)
+
+    if progress:
+        progress.finish()
+    elapsed = time.time() - startTime
+    if elapsed >= PROGRESS_MIN_MEASURE_TIME and totalBytes:
+        saveThroughput(pybObj, totalBytes / elapsed)
+
+    return elapsed
+
+
+def _doFlash(pybObj, localPath, remotePath, erase, forceBinary, flushAfterLines, verbose, keepPaths=(), delta=False, minify=False, isIgnored=None, onProgress=None, report=None):
+    '''
+    Copies a single file or a directory recursively to the remote device, without confirmation.
+    The whole transfer is planned in advance, thus it fails before changing anything when
+    the files don't fit. See _transferFiles.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param localPath: Path to the source file or directory.
+    @param remotePath: Path where the code will be copied within.
+    @param erase: Flag to preserve or erase already flashed contents.
+    @param forceBinary: Forces files to be copied in binary mode
+    @param flushAfterLines: Flushes text files after some lines. It is ignored for binary files.
+    @param verbose: Flag to print some information about the process.
+    @param keepPaths: (optional, default=()) Paths which won't be erased.
+    @param delta: (optional, default=False) Sends only the changed blocks of binary files.
+    @param minify: (optional, default=False) Removes comments, docstrings and indentation of Python sources.
+    @param isIgnored: (optional, default=None) Matcher of the items which won't be flashed.
+                      See compileIgnoreRules.
+    @param onProgress: (optional, default=None) Function which receives the progress. See TransferProgress.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
+    @return: The copied files as (local path, remote path, size) tuples, or None if they don't fit.
+    @rtype: list
+    '''
+
+    directories, files = planTransfer(localPath, _fullRemotePath(localPath, remotePath), isIgnored)
+    requiredSpace, availableSpace = checkFreeSpace(pybObj, directories, files, erase, verbose, keepPaths, delta, report)
+    if requiredSpace > availableSpace:
+        _report("Not enough space on the device: {0} bytes required, {1} bytes available. Aborting.".format(requiredSpace, availableSpace), report)
+        return None
+
+    if erase:
+        _doEraseAll(pybObj, verbose, keepPaths, report)
+
+    _transferFiles(pybObj, directories, files, forceBinary, flushAfterLines, verbose, delta, minify, onProgress, report)
+    return files
+
+
+#On-device routine removing a list of files in a single command. Their parent directories,
+#up to the root one, are removed too when they are left empty. It prints the number of
+#removed items and the list of failures as (path, error) tuples.
+REMOVE_PATHS_CODE = """
+import os
+def _removePaths(root, paths, failures):
+    count = 0
+    parents = set()
+    for path in paths:
+        try:
+            os.remove(path)
+            count += 1
+        except Exception as e:
+            failures.append((path, repr(e)))
+        parent = path.rsplit('/', 1)[0]
+        while parent.startswith(root + '/'):
+            parents.add(parent)
+            parent = parent.rsplit('/', 1)[0]
+    for parent in sorted(parents, key=len, reverse=True):
+        try:
+            if not os.listdir(parent):
+                os.rmdir(parent)
+                count += 1
+        except Exception as e:
+            failures.append((parent, repr(e)))
+    return count
+_failures = []
+_count = _removePaths({0!r}, {1!r}, _failures)
+print(repr((_count, _failures)))
+del _removePaths, _failures, _count
+"""
+
+
+def removePaths(pybObj, rootPath, remotePaths, verbose, report=None):
+    '''
+    Removes some files on the remote device, and the directories left empty by them.
+    The routine is executed on the device in a single command.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param rootPath: Absolute path of the remote directory containing the files. It is never removed.
+    @param remotePaths: Absolute paths of the remote files to remove.
+    @param verbose: Flag to print some information about the process.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
+    @return: Number of removed items and the list of failures as (path, error) tuples.
+    '''
+
+    rootPath = rootPath.replace("\\", "/").rstrip("/")
+    paths = tuple(path.replace("\\", "/") for path in remotePaths)
+    for path in paths:
+        printVerbose("Removing '{0}'".format(path), verbose, report)
+    result, resultError = pybObj.exec_raw(REMOVE_PATHS_CODE.format(rootPath, paths), timeout=None)
+    if resultError:
+        raise PyboardError("exception", result, resultError)
+    count, failures = ast.literal_eval(result.decode("ascii").strip())
+    printVerbose("{0} items deleted".format(count), verbose, report)
+    for path, error in failures:
+        _report("Could not delete '{0}': {1}".format(path, error), report)
+
+    return count, failures
+
+
+def _doSync(pybObj, localPath, remotePath, forceBinary, flushAfterLines, verbose, minify=False, isIgnored=None, onProgress=None, report=None):
+    '''
+    Makes the remote copy of a local file or directory equal to it, without confirmation.
+    Only the files whose contents differ are copied, and the remote files which don't exist
+    locally, or are ignored, are removed along with the directories left empty.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param localPath: Path to the source file or directory.
+    @param remotePath: Path where the code will be copied within.
+    @param forceBinary: Forces files to be copied in binary mode
+    @param flushAfterLines: Flushes text files after some lines. It is ignored for binary files.
+    @param verbose: Flag to print some information about the process.
+    @param minify: (optional, default=False) Removes comments, docstrings and indentation of Python sources.
+    @param isIgnored: (optional, default=None) Matcher of the items which won't be flashed.
+                      See compileIgnoreRules.
+    @param onProgress: (optional, default=None) Function which receives the progress. See TransferProgress.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
+    @return: The copied files as (local path, remote path, size) tuples and the removed remote paths,
+             or None if the files don't fit.
+    @rtype: tuple
+    '''
+
+    fullRemotePath = _fullRemotePath(localPath, remotePath)
+    directories, files = planTransfer(localPath, fullRemotePath, isIgnored)
+
+    existingPaths = []
+    isRemoteDir = os.path.isdir(localPath) and remotePathExists(pybObj, fullRemotePath)
+    if isRemoteDir:
+        existingPaths = [path for path, _ in remoteFiles(pybObj, fullRemotePath)]
+    elif os.path.isfile(localPath) and remotePathExists(pybObj, fullRemotePath):
+        existingPaths = [fullRemotePath]
+
+    plannedPaths = set(itemRemotePath for _, itemRemotePath, _ in files)
+    unchangedPaths = set()
+    candidates = [item for item in files if item[1] in existingPaths]
+    remoteDigests = remoteHashes(pybObj, [itemRemotePath for _, itemRemotePath, _ in candidates])
+    for (itemLocalPath, itemRemotePath, _), remoteDigest in zip(candidates, remoteDigests):
+        if hashlib.sha256(_flashedContents(itemLocalPath, forceBinary, minify)).hexdigest() == remoteDigest:
+            printVerbose("File '{0}' unchanged".format(itemLocalPath), verbose, report)
+            unchangedPaths.add(itemRemotePath)
+    changedFiles = [item for item in files if item[1] not in unchangedPaths]
+    stalePaths = [path for path in existingPaths if path not in plannedPaths]
+
+    requiredSpace, availableSpace = checkFreeSpace(pybObj, directories, changedFiles, False, verbose, report=report)
+    if requiredSpace > availableSpace:
+        _report("Not enough space on the device: {0} bytes required, {1} bytes available. Aborting.".format(requiredSpace, availableSpace), report)
+        return None
+
+    _transferFiles(pybObj, directories, changedFiles, forceBinary, flushAfterLines, verbose, False, minify, onProgress, report)
+    if stalePaths:
+        #Removed after the transfer, so the directories still in use are not pruned
+        removePaths(pybObj, fullRemotePath, stalePaths, verbose, report)
+    return changedFiles, stalePaths
+
+
+def flash(pybObj, localPath, remotePath, erase, forceBinary, flushAfterLines, verbose, keepPaths=(), delta=False, minify=False, isIgnored=None):
+    '''
+    Executes the flash functionality.
+    Ask the user for confirmation.
+    In case of positive confirmation, copies a single file or a directory recursively to the 
+    remote device. Already flashed contents can be preserved or erased as desired.
+    
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param remotePath: Path where the code will be copied within.
+    @param localPath: Path to the source file or directory.
+    @param erase: Flag to preserve or erase already flashed contents.
+    @param forceBinary: Forces files to be copied in binary mode
+    @param flushAfterLines: Flushes text files after some lines. It is ignored for binary files.
+    @param verbose: Flag to print some information about the process.
+    @param keepPaths: (optional, default=()) Paths which won't be erased.
+    @param delta: (optional, default=False) Sends only the changed blocks of binary files.
+    @param minify: (optional, default=False) Removes comments, docstrings and indentation of Python sources.
+    @param isIgnored: (optional, default=None) Matcher of the items which won't be flashed.
+                      See compileIgnoreRules.
+    @return: Whether the code was flashed.
+    @rtype: bool
+    '''
+
+    answer = input("The contents of MCU will be changed. Are you sure to proceed? (Y/n): ");
+    if answer and answer.startswith("Y"):
+
+        if _doFlash(pybObj, localPath, remotePath, erase, forceBinary, flushAfterLines, verbose, keepPaths, delta, minify, isIgnored) is not None:
+            print("Done. User code is available under the '" + APP_DIR_NAME + "' directory.")
+            return True
+        
+    else:
+        print("Aborted.")
+    
+    return False
+
+
+def _doEraseAll(pybObj, verbose, keepPaths=(), report=None):
+    '''
+    Erases all user code on the remote device.
+    
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param verbose: Flag to print some information about the process.
+    @param keepPaths: (optional, default=()) Paths which won't be erased. They can be absolute 
+                      or relative to the user code directory.
+    @param report: (optional, default=None) Function which receives the messages. If None, they are printed.
+    @return: Number of erased items and the list of failures. See eraseDir.
+    '''
+
+    existModules = remoteEval(pybObj, "'flash' in os.listdir('/') and '" + APP_DIR_NAME + "' in os.listdir('/flash')")
+    if existModules:
+        return eraseDir(pybObj, "/flash/" + APP_DIR_NAME, verbose, keepPaths, report)
+    
+    return 0, []
+
+
+def eraseAll(pybObj, verbose, keepPaths=()):
+    '''
+    Executes the "erase" option.
+    Ask the user for confirmation.
+    In case of positive confirmation, it erases all user code on the remote device.
+    
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param verbose: Flag to print some information about the process.
+    @param keepPaths: (optional, default=()) Paths which won't be erased. They can be absolute 
+                      or relative to the user code directory.
+    '''
+
+    existModules = remoteEval(pybObj, "'flash' in os.listdir('/') and '" + APP_DIR_NAME + "' in os.listdir('/flash')")
+    if existModules:
+        answer = input("The user code will be erased. Are you sure to proceed? (Y/n): ");
+        if answer and answer.startswith("Y"):
+            _doEraseAll(pybObj, verbose, keepPaths)
+            if keepPaths:
+                _initMain(pybObj)
+            else:
+                _doClearMain(pybObj)
+            print("Done.")
+        else:
+            print("Aborted.")
+    else:
+        print("The device has no user code flashed. Aborting.")
+        
+
+#On-device routine which lists the files within a remote directory recursively.
+#It prints a list of (path, size) tuples.
+REMOTE_FILES_CODE = """
+import os
+def _listFiles(path, files):
+    for itemName in os.listdir(path):
+        itemPath = path + '/' + itemName
+        stat = os.stat(itemPath)
+        if stat[0] & 0x4000:
+            _listFiles(itemPath, files)
+        else:
+            files.append((itemPath, stat[6]))
+    return files
+print(repr(_listFiles({0!r}, [])))
+del _listFiles
+"""
+
+#On-device routine which prints the SHA-256 hexdigests of a list of remote files.
+REMOTE_HASHES_CODE = """
+import uhashlib, ubinascii
+def _hashFile(path):
+    h = uhashlib.sha256()
+    with open(path, 'rb') as f:
+        buffer = f.read(512)
+        while buffer:
+            h.update(buffer)
+            buffer = f.read(512)
+    return ubinascii.hexlify(h.digest()).decode()
+print(repr([_hashFile(path) for path in {0!r}]))
+del _hashFile
+"""
+
+#On-device routine which prints a remote file as base64 lines.
+PULL_FILE_CODE = """
+import ubinascii
+with open({0!r}, 'rb') as _f:
+    _buffer = _f.read({1})
+    while _buffer:
+        print(ubinascii.b2a_base64(_buffer).decode().strip())
+        _buffer = _f.read({1})
+del _f, _buffer
+"""
+
+
+def remoteFiles(pybObj, remotePath):
+    '''
+    Lists the files within a remote directory recursively.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param remotePath: Path of the remote directory. This path must be absolute,
+                       that means starting with "/".
+    @return: Tuples as (path, size) for every remote file
+    @rtype: list
+    '''
+
+    result = pybObj.exec(REMOTE_FILES_CODE.format(remotePath.rstrip("/")))
+    return ast.literal_eval(result.decode("utf8").strip())
+
+
+def remoteHashes(pybObj, remotePaths):
+    '''
+    Computes the SHA-256 hash of some files on the remote device.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param remotePaths: Paths of the remote files.
+    @return: Hexdigests of the files, in the same order as the paths
+    @rtype: list
+    '''
+
+    if not remotePaths:
+        return []
+
+    result, resultError = pybObj.exec_raw(REMOTE_HASHES_CODE.format(list(remotePaths)), timeout=None)
+    if resultError:
+        raise PyboardError("exception", result, resultError)
+    return ast.literal_eval(result.decode("ascii").strip())
+
+
+def localHash(localPath):
+    '''
+    Computes the SHA-256 hash of a local file.
+
+    @param localPath: Path to the file.
+    @return: Hexdigest of the file
+    @rtype: str
+    '''
+
+    h = hashlib.sha256()
+    with open(localPath, "rb") as f:
+        for buffer in iter(lambda: f.read(65536), b""):
+            h.update(buffer)
+    return h.hexdigest()
+
+
+def pullFile(pybObj, remotePath, localPath, verbose):
+    '''
+    Copies a file from the remote device. The contents are written to disk as they arrive,
+    therefore the file is never held in memory as a whole.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param remotePath: Path of the remote file. This path must be absolute,
+                       that means starting with "/".
+    @param localPath: Path of the destination file. If the destination directory doesn't exist,
+                      it will be created.
+    @param verbose: Flag to print some information about the process.
+    '''
+
+    print("{0} => {1}".format(remotePath, localPath))
+
+    dirpath = os.path.dirname(localPath)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+
+    partPath = localPath + ".part"
+    try:
+        with open(partPath, "wb") as f:
+            pending = [b""]
+
+            def consumer(data):
+                lines = (pending[0] + data.replace(b"\x04", b"")).split(b"\n")
+                pending[0] = lines.pop()
+                for line in lines:
+                    line = line.strip()
+                    if line:
+                        f.write(binascii.a2b_base64(line))
+                        if not verbose:
+                            print(".", end="", flush=True)
+
+            result, resultError = pybObj.exec_raw(PULL_FILE_CODE.format(remotePath, PULL_BUFFER_SIZE), data_consumer=consumer)
+            if resultError:
+                raise PyboardError("exception", result, resultError)
+            consumer(b"\n")
+    except BaseException:
+        #A partial copy is never left behind, neither on interruption
+        os.remove(partPath)
+        raise
+
+    os.replace(partPath, localPath)
+    if not verbose:
+        print("|")
+
+
+def pull(pybObj, remotePath, localPath, verbose):
+    '''
+    Executes the "pull" option.
+    Copies the user code from the remote device into a local directory. Files which are
+    already equal on both sides are skipped.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param remotePath: Path within the user code directory to be copied.
+    @param localPath: Path to the destination directory.
+    @param verbose: Flag to print some information about the process.
+    '''
+
+    if not remoteEval(pybObj, "'flash' in os.listdir('/') and '" + APP_DIR_NAME + "' in os.listdir('/flash')"):
+        print("The device has no user code flashed. Aborting.")
+        return
+
+    rootPath = "/flash/" + APP_DIR_NAME + ("/" + remotePath.strip("/") if remotePath != "" else "")
+    if not remotePathExists(pybObj, rootPath):
+        print("Path '{0}' not found on the device. Aborting.".format(rootPath))
+        return
+
+    files = remoteFiles(pybObj, rootPath)
+    localPaths = [os.path.join(localPath, *path[len(rootPath) + 1:].split("/")) for path, size in files]
+
+    #Only the files with the same size on both sides are worth hashing
+    candidates = [i for i in range(len(files))
+                  if os.path.isfile(localPaths[i]) and os.path.getsize(localPaths[i]) == files[i][1]]
+    hashes = remoteHashes(pybObj, [files[i][0] for i in candidates])
+    unchanged = set(i for i, h in zip(candidates, hashes) if localHash(localPaths[i]) == h)
+
+    for i in range(len(files)):
+        if i in unchanged:
+            printVerbose("File '{0}' unchanged".format(localPaths[i]), verbose)
+        else:
+            pullFile(pybObj, files[i][0], localPaths[i], verbose)
+
+    print("Done. {0} files copied, {1} unchanged.".format(len(files) - len(unchanged), len(unchanged)))
+
+
+#On-device virtual filesystem which forwards the reads to the host. Every request is printed
+#as a line starting with MOUNT_REQUEST_MARK, and the host answers with a line which is
+#either "E<errno>" or "O<base64 payload>".
+MOUNT_CODE = """
+import os, sys, io, ubinascii
+class _RemoteFS:
+    def _request(self, *args):
+        print('\\x18' + repr(args))
+        line = sys.stdin.readline().strip()
+        if line[0] == 'E':
+            raise OSError(int(line[1:]))
+        return ubinascii.a2b_base64(line[1:])
+    def mount(self, readonly, mkfs):
+        self.cwd = '/'
+    def umount(self):
+        pass
+    def chdir(self, path):
+        self.cwd = path
+    def getcwd(self):
+        return self.cwd
+    def stat(self, path):
+        return eval(self._request('stat', path))
+    def ilistdir(self, path):
+        return iter(eval(self._request('ilistdir', path)))
+    def statvfs(self, path):
+        return (512, 512, 0, 0, 0, 0, 0, 0, 0, 255)
+    def open(self, path, mode):
+        if 'w' in mode or 'a' in mode or '+' in mode:
+            raise OSError(30)
+        data = self._request('open', path)
+        return io.BytesIO(data) if 'b' in mode else io.StringIO(data.decode())
+os.mount(_RemoteFS(), {0!r})
+sys.path.insert(0, {0!r})
+"""
+
+
+def _mountedItem(localPath, remotePath, path, isIgnored):
+    '''
+    Maps a path of the mounted filesystem to the local item. The mount point stands for the user
+    code directory, so the local items are found at the same paths where they would be flashed.
+
+    @param localPath: Path to the local file or directory served to the device.
+    @param remotePath: Path within the user code directory where the code would be copied into.
+    @param path: Path requested by the device, relative to the mount point.
+    @param isIgnored: Matcher of the items which aren't served. See compileIgnoreRules.
+    @return: Local path of the item, or None, and the entry (name, mode, inode) of the only item
+             within the directories containing the served code, or None. Both are None if the item
+             isn't served.
+    @rtype: tuple
+    '''
+
+    parts = [part for part in path.split("/") if part not in ("", ".")]
+    if ".." in parts:
+        return None, None
+    itemRemotePath = "/".join(["/flash", APP_DIR_NAME] + parts)
+    flashedPath = _fullRemotePath(localPath, remotePath)
+
+    if flashedPath.startswith(itemRemotePath + "/"):
+        childPath = flashedPath[len(itemRemotePath) + 1:]
+        isDir = "/" in childPath or os.path.isdir(localPath)
+        return None, (childPath.split("/")[0], 0x4000 if isDir else 0x8000, 0)
+    elif itemRemotePath != flashedPath and not itemRemotePath.startswith(flashedPath + "/"):
+        return None, None
+
+    itemPath = localPath
+    relParts = itemRemotePath[len(flashedPath):].split("/")[1:]
+    for index, part in enumerate(relParts):
+        itemPath = os.path.join(itemPath, part)
+        isDir = index < len(relParts) - 1 or os.path.isdir(itemPath)
+        if not os.path.exists(itemPath) or isIgnored(itemPath, isDir):
+            return None, None
+    if not os.path.exists(itemPath):
+        return None, None
+
+    return itemPath, None
+
+
+def _serveRequest(localPath, request, cache, remotePath="", isIgnored=None):
+    '''
+    Answers a request of the virtual filesystem installed on the device.
+
+    @param localPath: Path to the local file or directory served to the device.
+    @param request: Request as a tuple (operation, path).
+    @param cache: Dictionary of already read files as path => (modification time, contents).
+    @param remotePath: (optional, default="") Path within the user code directory where the code would be copied into.
+    @param isIgnored: (optional, default=None) Matcher of the items which aren't served.
+                      See compileIgnoreRules. If None, only the DEFAULT_IGNORE_RULES are applied.
+    @return: Response line.
+    @rtype: bytes
+    '''
+
+    if isIgnored is None:
+        isIgnored = compileIgnoreRules(localPath, DEFAULT_IGNORE_RULES)
+
+    operation, path = request
+    itemPath, childItem = _mountedItem(localPath, remotePath, path, isIgnored)
+    if itemPath is None and childItem is None:
+        return b"E2\n"
+
+    if childItem is not None:
+        #Directory on the way to the served code
+        if operation == "stat":
+            payload = repr((0x4000, 0, 0, 0, 0, 0, 0, 0, 0, 0)).encode("ascii")
+        elif operation == "ilistdir":
+            payload = repr([childItem]).encode("utf8")
+        elif operation == "open":
+            return b"E21\n"
+        else:
+            return b"E22\n"
+        return b"O" + binascii.b2a_base64(payload, newline=False) + b"\n"
+
+    if operation == "stat":
+        stat = os.stat(itemPath)
+        mode = 0x4000 if os.path.isdir(itemPath) else 0x8000
+        payload = repr((mode, 0, 0, 0, 0, 0, stat.st_size, int(stat.st_mtime), int(stat.st_mtime), int(stat.st_mtime))).encode("ascii")
+    elif operation == "ilistdir":
+        if not os.path.isdir(itemPath):
+            return b"E20\n"
+        items = []
+        for itemName in sorted(os.listdir(itemPath)):
+            isDir = os.path.isdir(os.path.join(itemPath, itemName))
+            if not isIgnored(os.path.join(itemPath, itemName), isDir):
+                items.append((itemName, 0x4000 if isDir else 0x8000, 0))
+        payload = repr(items).encode("utf8")
+    elif operation == "open":
+        if os.path.isdir(itemPath):
+            return b"E21\n"
+        mtime = os.path.getmtime(itemPath)
+        if itemPath not in cache or cache[itemPath][0] != mtime:
+            with open(itemPath, "rb") as f:
+                cache[itemPath] = (mtime, f.read())
+        payload = cache[itemPath][1]
+    else:
+        return b"E22\n"
+
+    return b"O" + binascii.b2a_base64(payload, newline=False) + b"\n"
+
+
+def mount(pybObj, localPath, entryPoint, verbose, remotePath="", isIgnored=None):
+    '''
+    Executes the "mount" option.
+    Mounts a local directory on the remote device, at the MOUNT_POINT path, and runs the entry point.
+    The MOUNT_POINT path stands for the user code directory, so the code is found at the same
+    paths where it would be flashed and the same entry point works in both cases.
+    The device reads the code from the host on demand, thus nothing is written into the device.
+    This function returns when the entry point finishes or the user presses Ctrl-C.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param localPath: Path to the local directory.
+    @param entryPoint: Path to the main function. See _doSetMain.
+    @param verbose: Flag to print some information about the process.
+    @param remotePath: (optional, default="") Path within the user code directory where the code would be copied into.
+    @param isIgnored: (optional, default=None) Matcher of the items which aren't served.
+                      See compileIgnoreRules. If None, only the DEFAULT_IGNORE_RULES are applied.
+    '''
+
+    if isIgnored is None:
+        isIgnored = compileIgnoreRules(localPath, DEFAULT_IGNORE_RULES)
+
+    mountedPath = MOUNT_POINT + _fullRemotePath(localPath, remotePath)[len("/flash/" + APP_DIR_NAME):]
+    print("Mounting '{0}' at '{1}'".format(localPath, mountedPath))
+    pybObj.exec(MOUNT_CODE.format(MOUNT_POINT))
+
+    modulePath = entryPoint[0:entryPoint.rfind(".")]
+    pybObj.exec_raw_no_follow("import {0}\n{1}()".format(modulePath, entryPoint))
+
+    cache = {}
+    requestLine = b""
+    endCount = 0
+    try:
+        #The bytes are read one by one, so nothing is read beyond the end of the program
+        while endCount < 2:
+            try:
+                byte = pybObj.read(1)
+            except KeyboardInterrupt:
+                pybObj.serial.write(b"\x03")
+                continue
+            if requestLine:
+                requestLine += byte
+                if byte == b"\n":
+                    request = ast.literal_eval(requestLine[1:].decode("utf8").strip())
+                    printVerbose("Request {0}".format(request), verbose)
+                    pybObj.serial.write(_serveRequest(localPath, request, cache, remotePath, isIgnored))
+                    requestLine = b""
+            elif byte == MOUNT_REQUEST_MARK:
+                requestLine = byte
+            elif byte == b"\x04":
+                #The program finishes after the ends of both the normal and the error outputs
+                endCount += 1
+            elif byte:
+                stdout.write(byte)
+                if pybObj.in_waiting() == 0:
+                    stdout.flush()
+    finally:
+        stdout.flush()
+        pybObj.exec("os.umount({0!r})".format(MOUNT_POINT))
+        pybObj.exec("sys.path.remove({0!r})".format(MOUNT_POINT))
+
+
+#On-device routine which imports a module measuring every import within. It prints the list of
+#imports as (module, depth, time in us, allocated bytes) tuples, in the order they finished.
+#The built-in modules are left out. The time spent on collecting the garbage before each 
+#measure is discounted.
+PROFILE_BOOT_CODE = """
+import sys, gc, utime, builtins
+sys.path.append('/flash/{0}')
+_records = []
+_state = [0, 0]
+_import = builtins.__import__
+def _profiledImport(name, *args):
+    if name in sys.modules:
+        return _import(name, *args)
+    gcStart = utime.ticks_us()
+    gc.collect()
+    _state[1] += utime.ticks_diff(utime.ticks_us(), gcStart)
+    gcTime = _state[1]
+    depth = _state[0]
+    _state[0] += 1
+    memFree = gc.mem_free()
+    start = utime.ticks_us()
+    module = None
+    try:
+        module = _import(name, *args)
+        return module
+    finally:
+        elapsed = utime.ticks_diff(utime.ticks_us(), start) - (_state[1] - gcTime)
+        _state[0] -= 1
+        if module is None or hasattr(module, '__file__'):
+            _records.append((name, depth, elapsed, memFree - gc.mem_free()))
+builtins.__import__ = _profiledImport
+try:
+    import {1}
+finally:
+    builtins.__import__ = _import
+print(repr(_records))
+"""
+
+
+def profileBoot(pybObj, entryPoint, verbose):
+    '''
+    Executes the "profile boot" option.
+    Imports the module of the entry point on the remote device, after a soft reset, and prints
+    the time and memory spent by each imported module, from the slowest to the fastest.
+    The entry point function itself isn't invoked.
+
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param entryPoint: Path to the main function. See _doSetMain.
+    @param verbose: Flag to print some information about the process.
+    @return: Tuples as (module, total time in us, own time in us, allocated bytes), sorted by total time.
+    @rtype: list
+    '''
+
+    modulePath = entryPoint[0:entryPoint.rfind(".")]
+    print("Profiling the import of '{0}'".format(modulePath))
+
+    #The soft reset clears the already imported modules
+    pybObj.enter_raw_repl()
+    pybObj.exec("import os")
+    result, resultError = pybObj.exec_raw(PROFILE_BOOT_CODE.format(APP_DIR_NAME, modulePath), timeout=None)
+    if resultError:
+        raise PyboardError("exception", result, resultError)
+    #The imported modules could print something too
+    records = ast.literal_eval(result.decode("utf8").strip().splitlines()[-1])
+
+    #The imports finish after the nested ones, so the own time of a module is its total time
+    #minus the time of the modules imported at the next depth since the previous one finished.
+    profile = []
+    pending = []
+    for name, depth, elapsed, allocated in records:
+        nestedTime = 0
+        while pending and pending[-1][0] > depth:
+            nestedDepth, nestedElapsed = pending.pop()
+            if nestedDepth == depth + 1:
+                nestedTime += nestedElapsed
+        pending.append((depth, elapsed))
+        profile.append((name, elapsed, elapsed - nestedTime, allocated))
+        printVerbose("{0}{1}".format("  " * depth, name), verbose)
+    profile.sort(key=lambda item: item[1], reverse=True)
+
+    print("{0:<32} {1:>10} {2:>10} {3:>10}".format("Module", "Total ms", "Own ms", "Bytes"))
+    for name, elapsed, ownElapsed, allocated in profile:
+        print("{0:<32} {1:>10.2f} {2:>10.2f} {3:>10}".format(name, elapsed / 1000.0, ownElapsed / 1000.0, allocated))
+
+    return profile
+
+
+#On-device routine which finds the block device of the main filesystem. It prints the 
+#filesystem type, the block size, the block count of the device and the mount point
+#of the filesystem, which is /flash on the pyboards and / on the rest of the ports.
+#The pyboard storage is taken from its first block, otherwise it's seen as a partition.
+IMAGE_BDEV_CODE = """
+import os
+_bdev = None
+try:
+    import pyb
+    _bdev = pyb.Flash(start=0)
+    _mountPoint = '/flash'
+except Exception:
+    _mountPoint = '/'
+    try:
+        import esp32
+        _bdev = esp32.Partition.find(esp32.Partition.TYPE_DATA, label='vfs')[0]
+    except Exception:
+        import rp2
+        _bdev = rp2.Flash()
+_blockSize = _bdev.ioctl(5, 0) or 512
+_block = bytearray(_blockSize)
+_bdev.readblocks(0, _block)
+if b'littlefs' in _block:
+    _fsType = 'lfs'
+elif _block[510:512] == b'\\x55\\xaa':
+    _fsType = 'fat'
+else:
+    _fsType = None
+print(repr((_fsType, _blockSize, _bdev.ioctl(4, 0), _mountPoint)))
+del _block
+"""
+
+#On-device helper which writes a chunk of the image and records it, so the failed
+#chunks can be found.
+IMAGE_WRITE_CODE = """
+import ubinascii
+_written = set()
+def _write(block, data):
+    _bdev.writeblocks(block, ubinascii.a2b_base64(data))
+    _written.add(block)
+"""
+
+
+def buildImage(localPath, remotePath, fsType, blockSize, blockCount, entryPoint=None, extraFiles=None, isIgnored=None, mountPoint="/flash"):
+    '''
+    Builds a filesystem image with the user code and the main.py file. The main.py file is at
+    the root of the filesystem and the user code under /flash/[APP_DIR_NAME] once mounted.
+    The 'littlefs-python' package is required for littlefs images and 'pyfatfs' for FAT images.
+    
+    @param localPath: Path to the source file or directory.
+    @param remotePath: Path within the user code directory where the code will be copied into.
+    @param fsType: Filesystem type. Either 'fat' or 'lfs'.
+    @param blockSize: Size of the blocks of the device.
+    @param blockCount: Number of blocks of the device.
+    @param entryPoint: (optional, default=None) Path to the main function. See _doSetMain.
+    @param extraFiles: (optional, default=None) Dictionary of other files to be included as path => bytes,
+                       being the path relative to the root of the filesystem, i.e. boot.py
+    @param isIgnored: (optional, default=None) Matcher of the items which won't be flashed.
+                      See compileIgnoreRules.
+    @param mountPoint: (optional, default="/flash") Path where the filesystem is mounted on the device.
+    @return: The filesystem image
+    @rtype: bytes
+    '''
+
+    rootPath = os.path.relpath(_fullRemotePath(localPath, remotePath), mountPoint).replace(os.sep, "/")
+
+    files = dict(extraFiles or {})
+    files["main.py"] = "".join(line + "\n" for line in _mainLines(entryPoint)).encode("utf8")
+    for itemLocalPath, itemRemotePath in _walkLocalFiles(localPath, rootPath, isIgnored):
+        with open(itemLocalPath, "rb") as f:
+            files[itemRemotePath] = f.read()
+    
+    if fsType == "lfs":
+        try:
+            from littlefs import LittleFS
+        except ImportError:
+            raise ImportError("The package 'littlefs-python' is required to build littlefs images.")
+        
+        #MicroPython can only mount images with the littlefs 2.0 on-disk version.
+        fs = LittleFS(block_size=blockSize, block_count=blockCount, disk_version=0x00020000)
+        for path, contents in files.items():
+            dirpath = os.path.dirname(path)
+            if dirpath:
+                fs.makedirs(dirpath, exist_ok=True)
+            with fs.open(path, "wb") as f:
+                f.write(contents)
+        image = bytes(fs.context.buffer)
+        
+    elif fsType == "fat":
+        try:
+            from pyfatfs.PyFat import PyFat
+            from pyfatfs.PyFatFS import PyFatFS
+        except ImportError:
+            raise ImportError("The package 'pyfatfs' is required to build FAT images.")
+        
+        fd, filename = tempfile.mkstemp(suffix=".img")
+        os.close(fd)
+        try:
+            with open(filename, "wb") as f:
+                f.truncate(blockSize * blockCount)
+            fatType = PyFat.FAT_TYPE_FAT12 if blockCount < 4085 else PyFat.FAT_TYPE_FAT16
+            pf = PyFat()
+            pf.mkfs(filename, fatType, size=blockSize * blockCount, sector_size=blockSize)
+            pf.close()
+            fs = PyFatFS(filename)
+            for path, contents in files.items():
+                dirpath = os.path.dirname(path)
+                if dirpath:
+                    fs.makedirs("/" + dirpath, recreate=True)
+                fs.writebytes("/" + path, contents)
+            fs.close()
+            with open(filename, "rb") as f:
+                image = f.read()
+        finally:
+            os.remove(filename)
+        
+    else:
+        raise ValueError("Unknown filesystem type '{0}'".format(fsType))
+    
+    return image
+
+
+def flashImage(pybObj, localPath, remotePath, entryPoint, verbose, isIgnored=None):
+    '''
+    Executes the "image" option.
+    Ask the user for confirmation.
+    In case of positive confirmation, builds a whole filesystem image on the host with the user
+    code and the main.py file, and writes it into the block device of the main filesystem.
+    All contents of the filesystem are replaced, but the boot.py file, which is preserved.
+    
+    @param pybObj: Interface with the remote device. Must be initializated previously.
+    @param localPath: Path to the source file or directory.
+    @param remotePath: Path within the user code directory where the code will be copied into.
+    @param entryPoint: Path to the main function. See _doSetMain. If None, no function will be invoked.
+    @param verbose: Flag to print some information about the process.
+    @param isIgnored: (optional, default=None) Matcher of the items which won't be flashed.
+                      See compileIgnoreRules.
+    @return: Whether the image was written.
+    @rtype: bool
+    '''
+
+    answer = input("The whole filesystem of the MCU will be replaced. Are you sure to proceed? (Y/n): ");
+    if answer and answer.startswith("Y"):
+    
+        result = pybObj.exec(IMAGE_BDEV_CODE)
+        fsType, blockSize, blockCount, mountPoint = ast.literal_eval(result.decode("ascii").strip())
+        if fsType is None:
+            print("The filesystem of the device is unknown. Aborting.")
+            return False
+        printVerbose("Filesystem '{0}' at '{1}': {2} blocks of {3} bytes".format(fsType, mountPoint, blockCount, blockSize), verbose)
+        
+        extraFiles = {}
+        bootPath = mountPoint.rstrip("/") + "/boot.py"
+        succeeded, contents = pybObj.eval_many(["open({0!r}, 'rb').read()".format(bootPath)])[0]
+        if succeeded:
+            extraFiles["boot.py"] = contents
+        
+        print("Building image...")
+        image = buildImage(localPath, remotePath, fsType, blockSize, blockCount, entryPoint, extraFiles, isIgnored, mountPoint)
+        
+        print("Writing image...")
+        pybObj.exec("os.umount({0!r})".format(mountPoint))
+        pybObj.exec(IMAGE_WRITE_CODE)
+        chunkSize = max(blockSize, IMAGE_CHUNK_SIZE - IMAGE_CHUNK_SIZE % blockSize)
+        missing = [offset // blockSize for offset in range(0, len(image), chunkSize)]
+        retries = 0
+        while missing:
+            for block in missing:
+                offset = block * blockSize
+                data = binascii.b2a_base64(image[offset:offset + chunkSize]).decode("ascii").strip()
+                try:
+                    _exec(pybObj, "_write({0}, '{1}')".format(block, data))
+                except PyboardError as error:
+                    printVerbose("Chunk of block {0} failed: {1}".format(block, error), verbose)
+                    _resync(pybObj)
+                if not verbose:
+                    print(".", end="", flush=True)
+                else:
+                    print("Block {0} written".format(block))
+            
+            missing = remoteEval(pybObj, "[block for block in {0!r} if block not in _written]".format(missing))
+            if missing:
+                retries += 1
+                if retries > BINARY_RETRIES:
+                    raise PyboardError("could not write the image, {0} chunks failed".format(len(missing)))
+                printVerbose("Writing {0} chunks again".format(len(missing)), verbose)
+        if not verbose:
+            print("|")
+        pybObj.exec("del _written, _write")
+        
+        vfsClass = "os.VfsLfs2" if fsType == "lfs" else "os.VfsFat"
+        pybObj.exec("os.mount({0}(_bdev), {1!r})".format(vfsClass, mountPoint))
+        pybObj.exec("os.chdir({0!r})".format(mountPoint))
+        print("Done. User code is available under the '" + APP_DIR_NAME + "' directory.")
+        return True
+        
+    else:
+        print("Aborted.")
+        return False
+
+
+#Result of the operations of a FlashSession which change the device: the name of the operation,
+#whether it succeeded, the seconds it took and a dictionary with the data of the operation.
+SessionResult = namedtuple("SessionResult", ["operation", "succeeded", "elapsed", "details"])
+
+
+class FlashSession(object):
+    '''
+    Programmatic interface to flash a device from other tools, i.e. test runners.
+    It owns a single connection with the device in raw REPL mode, which is reused by all the
+    operations. Nothing is asked for confirmation: the messages and the progress of the
+    operations are reported through callbacks, and the operations which change the
+    device return a SessionResult.
+
+        with FlashSession("/dev/ttyACM0") as session:
+            session.sync("myapp")
+            session.setMain("myapp.main.main")
+            session.eval("1 + 1")
+    '''
+
+    def __init__(self, device, baudrate=115200, verbose=False, onMessage=None, onProgress=None):
+        '''
+        @param device: The serial terminal or IP address where the MCU is attached to.
+        @param baudrate: (optional, default=115200) Speed of the serial terminal.
+        @param verbose: (optional, default=False) Flag to report more information about the processes.
+        @param onMessage: (optional, default=None) Function which receives each message. If None, the messages are discarded.
+        @param onProgress: (optional, default=None) Function which receives the progress of the transfers,
+                           as the transferred bytes, the total bytes and the estimated remaining seconds.
+        '''
+
+        self.verbose = verbose
+        self.onMessage = onMessage
+        self.onProgress = onProgress
+        self.pybObj = Pyboard(device, baudrate)
+        try:
+            self.reset()
+        except BaseException:
+            self.pybObj.close()
+            raise
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def close(self):
+        '''
+        Leaves the raw REPL and closes the connection.
+        '''
+
+        self.pybObj.exit_raw_repl()
+        self.pybObj.close()
+
+    def reset(self):
+        '''
+        Soft-resets the device, thus all the modules are imported again.
+        '''
+
+        self.pybObj.enter_raw_repl()
+        self.pybObj.exec("import os")
+        self.pybObj.exec("import utime")
+
+    def _message(self, message):
+
+        if self.onMessage:
+            self.onMessage(message)
+
+    def _progress(self, doneBytes, totalBytes, eta):
+
+        if self.onProgress:
+            self.onProgress(doneBytes, totalBytes, eta)
+
+    def _run(self, operation, function, *args):
+        '''
+        Runs an operation measuring its time.
+
+        @param operation: Name of the operation.
+        @param function: Function which runs the operation. It returns whether it succeeded and its data.
+        @param args: Arguments of the function.
+        @rtype: SessionResult
+        '''
+
+        startTime = time.time()
+        succeeded, details = function(*args)
+        return SessionResult(operation, succeeded, time.time() - startTime, details)
+
+    def flash(self, localPath, remotePath="", erase=False, forceBinary=False, flushAfterLines=FLUSH_AFTER_LINES,
+              keepPaths=(), delta=False, minify=False, excludes=(), includes=()):
+        '''
+        Copies a single file or a directory recursively to the device. See flash.
+        The details of the result are the copied 'files' as (local path, remote path, size) tuples,
+        the amount of 'bytes' and the 'throughput' in bytes per second.
+
+        @param localPath: Path to the source file or directory.
+        @param remotePath: (optional, default="") Path within the user code directory where the code will be copied into.
+        @param erase: (optional, default=False) Flag to erase already flashed contents.
+        @param forceBinary: (optional, default=False) Forces files to be copied in binary mode
+        @param flushAfterLines: (optional, default=FLUSH_AFTER_LINES) Flushes text files after some lines.
+        @param keepPaths: (optional, default=()) Paths which won't be erased.
+        @param delta: (optional, default=False) Sends only the changed blocks of binary files.
+        @param minify: (optional, default=False) Removes comments, docstrings and indentation of Python sources.
+        @param excludes: (optional, default=()) Patterns of the items to be ignored. See readIgnoreRules.
+        @param includes: (optional, default=()) Patterns of the items to be flashed anyway. See readIgnoreRules.
+        @rtype: SessionResult
+        '''
+
+        def run():
+            startTime = time.time()
+            files = _doFlash(self.pybObj, localPath, remotePath, erase, forceBinary, flushAfterLines, self.verbose,
+                        keepPaths, delta, minify, readIgnoreRules(localPath, excludes, includes), self._progress, self._message)
+            if files is None:
+                return False, {"files": [], "bytes": 0, "throughput": None}
+            totalBytes = sum(size for _, _, size in files)
+            return True, {"files": files, "bytes": totalBytes, "throughput": totalBytes / max(time.time() - startTime, 1e-6)}
+
+        return self._run("flash", run)
+
+    def sync(self, localPath, remotePath="", forceBinary=False, flushAfterLines=FLUSH_AFTER_LINES,
+             minify=False, excludes=(), includes=()):
+        '''
+        Makes the remote copy of a local file or directory equal to it, copying only the
+        changed files and removing the remote files which don't exist locally. See _doSync.
+        The details of the result are the 'copied' files as (local path, remote path, size) tuples,
+        the 'removed' remote paths and the amount of 'bytes' copied.
+
+        @param localPath: Path to the source file or directory.
+        @param remotePath: (optional, default="") Path within the user code directory where the code will be copied into.
+        @param forceBinary: (optional, default=False) Forces files to be copied in binary mode
+        @param flushAfterLines: (optional, default=FLUSH_AFTER_LINES) Flushes text files after some lines.
+        @param minify: (optional, default=False) Removes comments, docstrings and indentation of Python sources.
+        @param excludes: (optional, default=()) Patterns of the items to be ignored. See readIgnoreRules.
+        @param includes: (optional, default=()) Patterns of the items to be flashed anyway. See readIgnoreRules.
+        @rtype: SessionResult
+        '''
+
+        def run():
+            result = _doSync(self.pybObj, localPath, remotePath, forceBinary, flushAfterLines, self.verbose,
+                        minify, readIgnoreRules(localPath, excludes, includes), self._progress, self._message)
+            if result is None:
+                return False, {"copied": [], "removed": [], "bytes": 0}
+            copied, removed = result
+            return True, {"copied": copied, "removed": removed, "bytes": sum(size for _, _, size in copied)}
+
+        return self._run("sync", run)
+
+    def erase(self, keepPaths=()):
+        '''
+        Erases all user code on the device. See eraseAll.
+        The details of the result are the amount of 'erased' items and the 'failures' as (path, error) tuples.
+
+        @param keepPaths: (optional, default=()) Paths which won't be erased.
+        @rtype: SessionResult
+        '''
+
+        def run():
+            count, failures = _doEraseAll(self.pybObj, self.verbose, keepPaths, self._message)
+            if keepPaths:
+                _initMain(self.pybObj)
+            else:
+                _doClearMain(self.pybObj)
+            return not failures, {"erased": count, "failures": failures}
+
+        return self._run("erase", run)
+
+    def setMain(self, entryPoint):
+        '''
+        Sets the entry point function. See setMain.
+
+        @param entryPoint: Path to the main function. See _doSetMain.
+        @rtype: SessionResult
+        '''
+
+        def run():
+            _doSetMain(self.pybObj, entryPoint, self._message)
+            return True, {"entryPoint": entryPoint}
+
+        return self._run("setMain", run)
+
+    def clearMain(self):
+        '''
+        Removes the entry point function. See clearMain.
+
+        @rtype: SessionResult
+        '''
+
+        def run():
+            if remoteEval(self.pybObj, "'" + APP_DIR_NAME + "' in os.listdir('/flash')"):
+                _initMain(self.pybObj)
+            else:
+                _doClearMain(self.pybObj)
+            return True, {"entryPoint": None}
+
+        return self._run("clearMain", run)
+
+    def eval(self, expression):
+        '''
+        Evaluates an expression on the device.
+
+        @param expression: Python expression as a string.
+        @return: Result of the expression, or its representation if it isn't a literal.
+        @raise PyboardError: The expression raised an exception.
+        '''
+
+        return remoteEvalMany(self.pybObj, [expression])[0]
+
+    def evalMany(self, expressions):
+        '''
+        Evaluates several expressions on the device at once.
+
+        @param expressions: Python expressions as strings.
+        @return: Tuples as (succeeded, value) in the same order, being the value the error message
+                 when the expression failed.
+        @rtype: list
+        '''
+
+        return self.pybObj.eval_many(expressions)
+
+    def execute(self, command, timeout=10):
+        '''
+        Executes code on the device.
+
+        @param command: Python code as a string.
+        @param timeout: (optional, default=10) Seconds to wait for the code to finish. If None, it waits forever.
+        @return: Output of the code.
+        @rtype: str
+        @raise PyboardError: The code raised an exception.
+        '''
+
+        result, resultError = self.pybObj.exec_raw(command, timeout=timeout)
+        if resultError:
+            raise PyboardError("exception", result, resultError)
+        return result.decode("utf8")
+
 
 def main():
 
@@ -409,15 +2670,35 @@ def main():
     parser.add_argument("-b", "--binary", action="store_true", dest="forceBinary", help="Forces all files to be copied in binary mode.")
     parser.add_argument("-d", "--device", metavar="DEVICE", default=DEFAULT_TERMINAL,
                     help="(default='{0}') The serial terminal or IP address where the MCU is attached to.".format(DEFAULT_TERMINAL))
+    parser.add_argument("--delta", action="store_true",
+                    help="Sends only the changed blocks of binary files already present in the MCU.")
+    parser.add_argument("--dry-run", action="store_true", dest="dryRun",
+                    help="Lists the files which would be flashed and their sizes, without accessing the MCU.")
     parser.add_argument("-e", "--erase", action="store_true", help="Erases all user's Python code.")
+    parser.add_argument("--exclude", metavar="PATTERN", action="append", default=[],
+                    help="Ignores the items matching the gitignore-style PATTERN, in addition to the '{0}' file of LOCAL_PATH. This option can be used several times.".format(IGNORE_FILE_NAME))
+    parser.add_argument("-i", "--image", action="store_true",
+                    help="Builds a filesystem image with the application and writes it into the MCU at once. All contents of the MCU are replaced, but the boot.py file.")
+    parser.add_argument("--include", metavar="PATTERN", action="append", default=[],
+                    help="Flashes the items matching the gitignore-style PATTERN, even if they are ignored otherwise. This option can be used several times.")
+    parser.add_argument("-k", "--keep", metavar="PATH", action="append", default=[],
+                    help="Preserves the given path on erasing. It can be absolute or relative to the user code directory. This option can be used several times.")
     parser.add_argument("-l", "--lines", metavar="NUMBER", dest="flushAfterLines", default=FLUSH_AFTER_LINES, type=int,
                     help="(default={0}) Flushes text files after NUMBER lines. Ignored for binary files.".format(FLUSH_AFTER_LINES))
     parser.add_argument("-m", "--main", metavar="FUNCTION",
                     help="The passed function will be executed on start or reset, usualy the 'main' function. The Python's module notation is used, i.e. myapp.mymodule.myentrypoint. This function can not have any argument.")
+    parser.add_argument("--mount", action="store_true",
+                    help="Runs the FUNCTION given with --main reading the code of LOCAL_PATH from the host on demand. Nothing is written into the MCU.")
+    parser.add_argument("--minify", action="store_true",
+                    help="Removes comments, docstrings and indentation of Python sources before copying them. Line numbers are kept.")
     parser.add_argument("-n", "--nomain", action="store_true", dest="noMain",
                     help="Clear the entry point (main function) but sets path. Therefore the device executes no action after start or reset.")
+    parser.add_argument("--profile-boot", action="store_true", dest="profileBoot",
+                    help="Imports the module of the FUNCTION given with --main, after flashing if LOCAL_PATH is given, and shows the time and memory spent by each imported module.")
     parser.add_argument("-p", "--remotepath", metavar="REMOTE_PATH", default="",
                     help="The code will be copied into the given path.")
+    parser.add_argument("--pull", metavar="DEST",
+                    help="Copies the user code from the MCU into the DEST directory. Files already equal in DEST are skipped.")
     parser.add_argument("-v", "--verbose", action="store_true",
                     help="Show more information about the flashing process.")
     parser.add_argument("--version", action="version", version="%(prog)s v{0}".format(APP_VERSION))
@@ -429,19 +2710,34 @@ def main():
     #check args
     errors = False
 
-    if not args.erase and not args.path and not args.noMain and not args.main:
+    if not args.erase and not args.path and not args.noMain and not args.main and not args.pull:
         print("Arguments missed.\n")
         errors = True
 
+    if args.mount and (not args.path or not args.main):
+        print("Mount mode requires both LOCAL_PATH and FUNCTION.\n")
+        errors = True
+
+    if args.profileBoot and not args.main:
+        print("Boot profiling requires FUNCTION.\n")
+        errors = True
+
+    if args.dryRun and not args.path:
+        print("Dry run requires LOCAL_PATH.\n")
+        errors = True
+
     if args.path and not os.path.exists(args.path):
         print("Path '{0}' not found.".format(args.path))
         errors = True
         
-    if not sys.platform.startswith("win") and not os.path.exists(args.device):
+    if not args.dryRun and not sys.platform.startswith("win") and not os.path.exists(args.device):
         print("Device '{0}' not found.".format(args.device))
         errors = True
     
-    if not errors:
+    if not errors and args.dryRun:
+        dryRun(args.path, args.remotepath, readIgnoreRules(args.path, args.exclude, args.include))
+    
+    elif not errors:
         #proceed
         pyb = Pyboard(args.device)
         pyb.enter_raw_repl()
@@ -449,21 +2745,39 @@ def main():
             pyb.exec("import os")
             pyb.exec("import utime")
             
-            if args.path:
-                flash(pyb, args.path, args.remotepath, args.erase, args.forceBinary, args.flushAfterLines, args.verbose)
+            isIgnored = readIgnoreRules(args.path, args.exclude, args.include) if args.path else None
+            
+            if args.pull:
+                pull(pyb, args.remotepath, args.pull, args.verbose)
+            
+            elif args.mount:
+                mount(pyb, args.path, args.main, args.verbose, args.remotepath, isIgnored)
+            
+            elif args.path and args.image:
+                if flashImage(pyb, args.path, args.remotepath, args.main, args.verbose, isIgnored) and args.profileBoot:
+                    profileBoot(pyb, args.main, args.verbose)
                 
-                if args.main:
-                    _doSetMain(pyb, args.main)
-                elif args.noMain:
-                    _initMain(pyb)
-                    print("Entry point cleared.")
+            elif args.path:
+                #The entry point isn't changed when the code wasn't flashed
+                if flash(pyb, args.path, args.remotepath, args.erase, args.forceBinary, args.flushAfterLines, args.verbose, args.keep, args.delta, args.minify, isIgnored):
+                    if args.main:
+                        _doSetMain(pyb, args.main)
+                    elif args.noMain:
+                        _initMain(pyb)
+                        print("Entry point cleared.")
+                    
+                    if args.profileBoot:
+                        profileBoot(pyb, args.main, args.verbose)
                     
             elif args.erase:
-                eraseAll(pyb, args.verbose)
+                eraseAll(pyb, args.verbose, args.keep)
             
             elif args.noMain:
                 clearMain(pyb)
                 
+            elif args.profileBoot:
+                profileBoot(pyb, args.main, args.verbose)
+                
             elif args.main:
                 setMain(pyb, args.main)
         finally:
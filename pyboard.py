@@ -85,6 +85,93 @@ def stdout_write_bytes(b):
 class PyboardError(Exception):
     pass
 
+class ConsoleCapture:
+    """Buffered data_consumer for the output of the board.
+
+    The output is written to stdout in batches, flushed when the board has no
+    more data waiting or after flush_interval seconds. Optionally, every line
+    is also written with a host timestamp into a log file, which is rotated
+    once it reaches log_max_bytes. Periods where the host falls behind, i.e.
+    more than backlog_threshold bytes are waiting to be read, are reported
+    as they can make the board stall or drop output."""
+
+    def __init__(self, pyb, log_file=None, log_max_bytes=1024 * 1024, log_backups=5,
+            flush_interval=0.1, backlog_threshold=4096):
+        self.pyb = pyb
+        self.log_file = log_file
+        self.log_max_bytes = log_max_bytes
+        self.log_backups = log_backups
+        self.flush_interval = flush_interval
+        self.backlog_threshold = backlog_threshold
+        self.last_flush = time.time()
+        self.backlog_start = None
+        self.backlog_max = 0
+        self.backlog_periods = []
+        self.line = b''
+        self.log = None
+        if log_file:
+            self.log = open(log_file, 'ab')
+
+    def __call__(self, data):
+        data = data.replace(b'\x04', b'')
+        stdout.write(data)
+        now = time.time()
+        waiting = self.pyb.in_waiting()
+        if waiting == 0 or now - self.last_flush >= self.flush_interval:
+            stdout.flush()
+            self.last_flush = now
+        self._check_backlog(waiting, now)
+        if self.log:
+            lines = (self.line + data).split(b'\n')
+            self.line = lines.pop()
+            self._write_log(lines, now)
+
+    def _write_log(self, lines, now):
+        if not lines:
+            return
+        # all the lines of a chunk arrived at the same time
+        stamp = (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)) + '.%03d ' % (now % 1 * 1000)).encode('ascii')
+        self.log.write(b''.join(stamp + line.rstrip(b'\r') + b'\n' for line in lines))
+        if self.log.tell() >= self.log_max_bytes:
+            self.log.close()
+            for i in range(self.log_backups - 1, 0, -1):
+                if os.path.exists('%s.%d' % (self.log_file, i)):
+                    os.replace('%s.%d' % (self.log_file, i), '%s.%d' % (self.log_file, i + 1))
+            if self.log_backups > 0:
+                os.replace(self.log_file, self.log_file + '.1')
+            self.log = open(self.log_file, 'wb')
+
+    def _check_backlog(self, waiting, now):
+        if waiting >= self.backlog_threshold:
+            if self.backlog_start is None:
+                self.backlog_start = now
+                self.backlog_max = 0
+            self.backlog_max = max(self.backlog_max, waiting)
+        elif self.backlog_start is not None:
+            period = (self.backlog_start, now - self.backlog_start, self.backlog_max)
+            self.backlog_periods.append(period)
+            self.backlog_start = None
+            if self.log:
+                self._write_log([b'[capture] %d bytes backlog during %.3f s, output may have been dropped'
+                    % (period[2], period[1])], now)
+
+    def close(self):
+        stdout.flush()
+        now = time.time()
+        self._check_backlog(0, now)
+        if self.log:
+            if self.line:
+                self._write_log([self.line], now)
+                self.line = b''
+            self.log.close()
+            self.log = None
+        if self.backlog_periods:
+            sys.stderr.write('%d periods with more than %d bytes backlog, output may have been dropped:\n'
+                % (len(self.backlog_periods), self.backlog_threshold))
+            for start, duration, backlog in self.backlog_periods:
+                sys.stderr.write('  %s: %d bytes during %.3f s\n'
+                    % (time.strftime('%H:%M:%S', time.localtime(start)), backlog, duration))
+
 class TelnetToSerial:
     def __init__(self, ip, user, password, read_timeout=None):
         self.tn = None
@@ -226,7 +313,12 @@ class ProcessPtyToTerminal:
 
 
 class Pyboard:
+    # maximum number of bytes read at once when the data goes to a data_consumer
+    read_chunk_size = 4096
+
     def __init__(self, device, baudrate=115200, user='micro', password='python', wait=0):
+        # bytes read from the serial but not consumed yet
+        self.pending = b''
         if device.startswith("exec:"):
             self.serial = ProcessToSerial(device[len("exec:"):])
         elif device.startswith("execpty:"):
@@ -260,23 +352,45 @@ class Pyboard:
     def close(self):
         self.serial.close()
 
+    def read(self, size):
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        if len(data) < size:
+            data += self.serial.read(size - len(data))
+        return data
+
+    def in_waiting(self):
+        return len(self.pending) + self.serial.inWaiting()
+
+    def read_chunk(self, ending):
+        # read all the waiting bytes, up to read_chunk_size, but not beyond the ending
+        n = self.serial.inWaiting()
+        data = self.pending + self.serial.read(min(n, self.read_chunk_size))
+        self.pending = b''
+        i = data.find(ending)
+        if i >= 0:
+            self.pending = data[i + len(ending):]
+            data = data[:i + len(ending)]
+        return data
+
     def read_until(self, min_num_bytes, ending, timeout=10, data_consumer=None):
         # if data_consumer is used then data is not accumulated and the ending must be 1 byte long
         assert data_consumer is None or len(ending) == 1
 
-        data = self.serial.read(min_num_bytes)
+        data = self.read(min_num_bytes)
         if data_consumer:
             data_consumer(data)
         timeout_count = 0
         while True:
             if data.endswith(ending):
                 break
-            elif self.serial.inWaiting() > 0:
-                new_data = self.serial.read(1)
+            elif self.in_waiting() > 0:
                 if data_consumer:
+                    new_data = self.read_chunk(ending)
                     data_consumer(new_data)
                     data = new_data
                 else:
+                    new_data = self.read(1)
                     data = data + new_data
                 timeout_count = 0
             else:
@@ -290,6 +404,7 @@ class Pyboard:
         self.serial.write(b'\r\x03\x03') # ctrl-C twice: interrupt any running program
 
         # flush input (without relying on serial.flushInput())
+        self.pending = b''
         n = self.serial.inWaiting()
         while n > 0:
             self.serial.read(n)
@@ -350,7 +465,7 @@ class Pyboard:
         self.serial.write(b'\x04')
 
         # check if we could exec command
-        data = self.serial.read(2)
+        data = self.read(2)
         if data != b'OK':
             raise PyboardError('could not exec command (response: %r)' % data)
 
@@ -363,6 +478,34 @@ class Pyboard:
         ret = ret.strip()
         return ret
 
+    def eval_many(self, expressions):
+        # evaluate all the expressions with a single exec; each result is returned
+        # as (True, value), or as (False, 'ExceptionName: message') if it raised
+        import ast
+        if not expressions:
+            return []
+        command = ('for _e in %r:\n'
+                   ' try:\n'
+                   '  print("\\x1e0" + repr(eval(_e)))\n'
+                   ' except Exception as _x:\n'
+                   '  print("\\x1e1" + repr("%%s: %%s" %% (type(_x).__name__, _x)))\n'
+                   'del _e\n') % (tuple(expressions),)
+        ret = self.exec_(command)
+        results = []
+        for line in ret.decode('utf8').split('\n'):
+            if not line.startswith('\x1e'):
+                continue
+            text = line[2:].rstrip('\r')
+            try:
+                value = ast.literal_eval(text)
+            except (ValueError, SyntaxError):
+                # not a literal, e.g. an object repr
+                value = text
+            results.append((line[1] == '0', value))
+        if len(results) != len(expressions):
+            raise PyboardError('unexpected eval_many response', ret)
+        return results
+
     def exec_(self, command):
         ret, ret_err = self.exec_raw(command)
         if ret_err:
@@ -400,6 +543,9 @@ def main():
     cmd_parser.add_argument('-c', '--command', help='program passed in as string')
     cmd_parser.add_argument('-w', '--wait', default=0, type=int, help='seconds to wait for USB connected board to become available')
     cmd_parser.add_argument('--follow', action='store_true', help='follow the output after running the scripts [default if no scripts given]')
+    cmd_parser.add_argument('--log', metavar='FILE', help='also write the output into FILE, with a host timestamp per line')
+    cmd_parser.add_argument('--log-max-bytes', default=1024 * 1024, type=int, help='rotate the log file once it reaches this size')
+    cmd_parser.add_argument('--log-backups', default=5, type=int, help='number of rotated log files to keep')
     cmd_parser.add_argument('files', nargs='*', help='input files')
     args = cmd_parser.parse_args()
 
@@ -410,6 +556,8 @@ def main():
         print(er)
         sys.exit(1)
 
+    capture = ConsoleCapture(pyb, args.log, args.log_max_bytes, args.log_backups)
+
     # run any command or file(s)
     if args.command is not None or len(args.files):
         # we must enter raw-REPL mode to execute commands
@@ -423,17 +571,21 @@ def main():
 
         def execbuffer(buf):
             try:
-                ret, ret_err = pyb.exec_raw(buf, timeout=None, data_consumer=stdout_write_bytes)
+                ret, ret_err = pyb.exec_raw(buf, timeout=None, data_consumer=capture)
             except PyboardError as er:
+                capture.close()
                 print(er)
                 pyb.close()
                 sys.exit(1)
             except KeyboardInterrupt:
+                capture.close()
                 sys.exit(1)
             if ret_err:
+                # the capture probes the port, so it's finished before closing it
+                capture(ret_err)
+                capture.close()
                 pyb.exit_raw_repl()
                 pyb.close()
-                stdout_write_bytes(ret_err)
                 sys.exit(1)
 
         # run the command, if given
@@ -452,18 +604,22 @@ def main():
     # if asked explicitly, or no files given, then follow the output
     if args.follow or (args.command is None and len(args.files) == 0):
         try:
-            ret, ret_err = pyb.follow(timeout=None, data_consumer=stdout_write_bytes)
+            ret, ret_err = pyb.follow(timeout=None, data_consumer=capture)
         except PyboardError as er:
+            capture.close()
             print(er)
             sys.exit(1)
         except KeyboardInterrupt:
+            capture.close()
             sys.exit(1)
         if ret_err:
+            capture(ret_err)
+            capture.close()
             pyb.close()
-            stdout_write_bytes(ret_err)
             sys.exit(1)
 
     # close the connection to the pyboard
+    capture.close()
     pyb.close()
 
 if __name__ == "__main__":